@@ -1,21 +1,81 @@
 #!/usr/bin/env python3
 import os
 import re
-import requests
-import subprocess
 import time
 import sys
 import html
+import subprocess
+import mmap
+import struct
+import bisect
+import heapq
+import shutil
+import tempfile
+import threading
+import queue
+import zlib
+import pickle
+import multiprocessing
+from array import array
+from collections import OrderedDict, deque
+from itertools import chain, groupby
+from operator import itemgetter
+from telegram_client import TelegramClient, TelegramError
 
 # Inserisci qui il token del tuo Bot Telegram
 TOKEN = ""
-BASE_URL = f"https://api.telegram.org/bot{TOKEN}"
+telegram = TelegramClient(TOKEN)
 
 # Nome del file su cui effettuare la ricerca
 FILE_NAME = "fb_italy.txt"
 
+# Indice invertito (token -> righe) di FILE_NAME, ricostruito quando il file cambia.
+# Si crea con: python3 fbquery_bot.py --build-index
+INDEX_FILE = FILE_NAME + ".idx"
+# Memoria stimata (byte) di un segmento tenuto in RAM durante la build prima di
+# scaricarlo su disco: ogni token distinto costa molto più dei suoi posting
+INDEX_SEGMENT_BYTES = 64 * 1024 * 1024
+INDEX_TOKEN_OVERHEAD = 200  # stima di dict + str + array per token, oltre al testo
+# Oltre queste soglie (righe, o token del vocabolario che lo contengono) un termine
+# è poco selettivo: non serve a filtrare le righe e conviene la scansione
+INDEX_MAX_FILTER_POSTINGS = 1_000_000
+INDEX_MAX_FILTER_TOKENS = 10_000
+
+# Risultati inviati per ogni ricerca: superati questi limiti il resto si ottiene con /more
+MAX_HITS = 200
+MAX_RESULT_BYTES = 64 * 1024
+# Dimensione massima di un messaggio (lasciamo spazio per i tag <pre> e </pre>)
+MESSAGE_CHUNK = 4000
+# Il primo blocco di risultati parte al più dopo questo tempo, anche se non è pieno
+RESULT_FLUSH_SECONDS = 1.0
+# Dopo questo tempo (secondi) una ricerca sospesa non si può più riprendere con /more
+PENDING_RESULTS_TTL = 600
+
+# Ricerche eseguite in parallelo (le altre attendono in coda) e richieste in coda per chat
+SEARCH_WORKERS = 4
+MAX_QUEUED_PER_CHAT = 3
+# Tempo massimo (secondi) per una pagina di risultati: oltre, la scansione viene interrotta
+QUERY_TIMEOUT = 120
+# Byte scansionati tra un controllo di interruzione e l'altro
+SCAN_BLOCK = 16 * 1024 * 1024
+
+# Cache dei risultati (LRU, in byte) e file in cui conservarla tra i riavvii ("" per disattivarlo)
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MAX_ENTRY_BYTES = CACHE_MAX_BYTES // 4
+CACHE_LINE_OVERHEAD = 64  # stima dell'occupazione di una stringa Python oltre al testo
+CACHE_FILE = "fbquery_cache.pickle"
+CACHE_SAVE_INTERVAL = 300
+
+# Scansione parallela senza indice: processi, dimensione degli shard e shard in volo per processo
+SCAN_PROCESSES = os.cpu_count() or 1
+SHARD_SIZE = 64 * 1024 * 1024
+SHARD_WINDOW = 2
+
 # Dizionario per gestire lo stato di ogni chat
 user_states = {}
+# Ricerche sospese per ogni chat, riprese con /more: (risultati, cancel, timer di scadenza)
+pending_results = {}
+pending_lock = threading.Lock()
 
 # Funzione per rimuovere le sequenze di escape ANSI (per sicurezza)
 ansi_escape = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
@@ -26,14 +86,10 @@ def send_message(chat_id, text, parse_mode=None):
     """
     Invia un messaggio tramite il metodo sendMessage dell'API Telegram.
     """
-    url = f"{BASE_URL}/sendMessage"
-    data = {"chat_id": chat_id, "text": text}
-    if parse_mode:
-        data["parse_mode"] = parse_mode
     try:
-        response = requests.post(url, data=data)
+        telegram.send_message(chat_id, text, parse_mode=parse_mode)
         print(f"Inviato messaggio a {chat_id}: {text}", flush=True)
-    except Exception as e:
+    except TelegramError as e:
         print("Errore nell'invio del messaggio:", e, flush=True)
 
 def send_long_message(chat_id, text, parse_mode="HTML"):
@@ -42,16 +98,850 @@ def send_long_message(chat_id, text, parse_mode="HTML"):
     Questa funzione suddivide il testo in chunk, esegue l'escape per HTML e
     lo racchiude tra <pre>...</pre> in modo da mantenere l'aspetto "da terminale".
     """
-    max_length = 4000  # Lasciamo spazio per i tag <pre> e </pre>
+    max_length = MESSAGE_CHUNK
     for i in range(0, len(text), max_length):
         chunk = text[i:i+max_length]
         chunk_escaped = html.escape(chunk)
         formatted_chunk = f"<pre>{chunk_escaped}</pre>"
         send_message(chat_id, formatted_chunk, parse_mode=parse_mode)
 
+# ------------------------------------------------------------------------------
+# INDICE INVERTITO SU DISCO
+# ------------------------------------------------------------------------------
+# Formato del file INDEX_FILE (interi nativi, sezioni allineate a 8 byte):
+#   header        magic, dimensione/mtime del file sorgente, contatori, crc32 della coda
+#   line_offsets  uint64[n_lines + 1]   offset di inizio di ogni riga (+ fine file)
+#   token_starts  uint64[n_tokens + 1]  inizio di ogni token nel vocabolario
+#   post_starts   uint64[n_tokens + 1]  inizio dei posting di ogni token
+#   vocab         token ordinati, ognuno terminato da "\n"
+#   postings      uint32[n_postings]    numeri di riga, ordinati per token
+_INDEX_MAGIC = b"FBIDX001"
+_INDEX_HEADER = struct.Struct("=8s6QI4x")
+# Byte finali del sorgente usati per riconoscere un file a cui sono solo state aggiunte righe
+_INDEX_TAIL_BYTES = 65536
+_TOKEN_RE = re.compile(r"\w+")
+
+_index_lock = threading.Lock()
+_index_cache = None
+_index_build_thread = None
+
+def _pad8(n):
+    return (n + 7) & ~7
+
+def _tokenize(line):
+    return set(_TOKEN_RE.findall(line.lower()))
+
+def _tail_crc(f, size):
+    start = max(0, size - _INDEX_TAIL_BYTES)
+    f.seek(start)
+    return zlib.crc32(f.read(size - start))
+
+class SearchIndex:
+    """
+    Indice invertito memory-mapped di FILE_NAME: per ogni token (minuscolo)
+    contiene la lista ordinata dei numeri di riga in cui compare.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.src_size, self.src_mtime_ns, self.n_lines, self.n_tokens,
+         vocab_len, n_postings, self.tail_crc) = _INDEX_HEADER.unpack_from(self.mm, 0)
+        if magic != _INDEX_MAGIC:
+            self.close()
+            raise ValueError(f"{path} non è un indice valido")
+        mv = memoryview(self.mm)
+        pos = _INDEX_HEADER.size
+        self.line_offsets = mv[pos:pos + 8 * (self.n_lines + 1)].cast("Q")
+        pos += 8 * (self.n_lines + 1)
+        self.token_starts = mv[pos:pos + 8 * (self.n_tokens + 1)].cast("Q")
+        pos += 8 * (self.n_tokens + 1)
+        self.post_starts = mv[pos:pos + 8 * (self.n_tokens + 1)].cast("Q")
+        pos += 8 * (self.n_tokens + 1)
+        self.vocab_start = pos
+        self.vocab_end = pos + vocab_len
+        self.postings_pos = pos + _pad8(vocab_len)
+        self.postings = mv[self.postings_pos:self.postings_pos + 4 * n_postings].cast("I")
+        self.index_mtime_ns = os.fstat(self.f.fileno()).st_mtime_ns
+
+    def close(self):
+        for name in ("line_offsets", "token_starts", "post_starts", "postings"):
+            view = getattr(self, name, None)
+            if view is not None:
+                view.release()
+        self.mm.close()
+        self.f.close()
+
+    def is_fresh(self, st):
+        """Vero se l'indice corrisponde alla versione attuale del file sorgente."""
+        return st.st_size == self.src_size and st.st_mtime_ns == self.src_mtime_ns
+
+    def iter_tokens(self):
+        """Restituisce (token, array di righe) in ordine di vocabolario."""
+        for i in range(self.n_tokens):
+            a = self.vocab_start + self.token_starts[i]
+            b = self.vocab_start + self.token_starts[i + 1] - 1
+            postings = array("I")
+            postings.frombytes(self.mm[self.postings_pos + 4 * self.post_starts[i]:
+                                       self.postings_pos + 4 * self.post_starts[i + 1]])
+            yield self.mm[a:b].decode("utf-8"), postings
+
+    def _term_ranges(self, term, cancel=None):
+        """
+        Intervalli di posting di tutti i token che contengono `term`, più il
+        totale dei posting. La ricerca è per sottostringa, come quella di rg.
+        Restituisce None appena il termine supera INDEX_MAX_FILTER_TOKENS token
+        o INDEX_MAX_FILTER_POSTINGS posting, senza leggere il resto del vocabolario.
+        """
+        needle = term.encode("utf-8")
+        ranges = []
+        total = 0
+        pos = self.mm.find(needle, self.vocab_start, self.vocab_end)
+        while pos != -1:
+            if len(ranges) >= INDEX_MAX_FILTER_TOKENS:
+                return None
+            if len(ranges) % 1024 == 0 and cancel is not None and cancel.is_set():
+                raise SearchCancelled()
+            i = bisect.bisect_right(self.token_starts, pos - self.vocab_start) - 1
+            a, b = self.post_starts[i], self.post_starts[i + 1]
+            ranges.append((a, b))
+            total += b - a
+            if total > INDEX_MAX_FILTER_POSTINGS:
+                return None
+            pos = self.mm.find(needle, self.vocab_start + self.token_starts[i + 1], self.vocab_end)
+        return ranges, total
+
+    def _lines(self, ranges):
+        """Numeri di riga ordinati, senza doppioni, degli intervalli di posting."""
+        if len(ranges) == 1:
+            # i posting di un token sono già ordinati
+            a, b = ranges[0]
+            return self.postings[a:b].tolist()
+        return sorted(set(chain.from_iterable(self.postings[a:b] for a, b in ranges)))
+
+    def candidate_lines(self, keywords, cancel=None):
+        """
+        Interseca i posting delle keyword (AND) e restituisce i numeri di riga
+        candidati, ordinati. I termini poco selettivi non vengono usati per
+        filtrare (le righe vengono comunque verificate); restituisce None se
+        nessun termine è abbastanza selettivo e conviene una scansione completa.
+        """
+        terms = {t for kw in keywords for t in _TOKEN_RE.findall(kw.lower())}
+        lookups = []
+        for term in terms:
+            found = self._term_ranges(term, cancel)
+            if found is None:
+                continue
+            if not found[0]:
+                return []  # nessun token contiene il termine: nessuna riga
+            lookups.append(found)
+        if not lookups:
+            return None
+        lookups.sort(key=itemgetter(1))
+        candidates = self._lines(lookups[0][0])
+        for ranges, total in lookups[1:]:
+            if not candidates:
+                break
+            if cancel is not None and cancel.is_set():
+                raise SearchCancelled()
+            lines = set(chain.from_iterable(self.postings[a:b] for a, b in ranges))
+            candidates = [n for n in candidates if n in lines]
+        return candidates
+
+    def iter_matches(self, file_name, candidates, keywords, cancel=None):
+        """
+        Legge da `file_name` solo le righe candidate e restituisce, una alla
+        volta, quelle che contengono davvero tutte le keyword.
+        """
+        patterns = [keyword_pattern(kw) for kw in keywords]
+        with open(file_name, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for n, line_no in enumerate(candidates):
+                    if n % 1024 == 0 and cancel is not None and cancel.is_set():
+                        raise SearchCancelled()
+                    start, end = self.line_offsets[line_no], self.line_offsets[line_no + 1]
+                    if all(p.search(data, start, end) for p in patterns):
+                        yield data[start:end].decode("utf-8", errors="replace").rstrip("\r\n")
+
+def _write_run(postings, tmpdir):
+    """Scarica su un file temporaneo un segmento di posting ordinato per token."""
+    f = tempfile.TemporaryFile(dir=tmpdir)
+    for token in sorted(postings):
+        data = token.encode("utf-8")
+        f.write(struct.pack("=II", len(data), len(postings[token])))
+        f.write(data)
+        postings[token].tofile(f)
+    f.seek(0)
+    return f
+
+def _read_run(f):
+    while True:
+        hdr = f.read(8)
+        if not hdr:
+            return
+        tlen, count = struct.unpack("=II", hdr)
+        token = f.read(tlen).decode("utf-8")
+        postings = array("I")
+        postings.frombytes(f.read(4 * count))
+        yield token, postings
+
+def build_index(file_name=FILE_NAME, index_file=INDEX_FILE):
+    """
+    Costruisce (o aggiorna) l'indice invertito di `file_name`.
+    Se al file sono state solo aggiunte righe in coda, indicizza solo quelle
+    e le fonde con l'indice esistente; altrimenti ricostruisce da zero.
+    """
+    started = time.time()
+    st = os.stat(file_name)
+    old = None
+    try:
+        old = SearchIndex(index_file)
+    except (OSError, ValueError):
+        pass
+
+    tmpdir = os.path.dirname(os.path.abspath(index_file))
+    with open(file_name, "rb") as src:
+        start_byte, start_line = 0, 0
+        if old is not None:
+            if old.is_fresh(st):
+                old.close()
+                return
+            appended = st.st_size > old.src_size and old.tail_crc == _tail_crc(src, old.src_size)
+            if appended and old.src_size > 0:
+                # l'ultima riga indicizzata deve essere completa
+                src.seek(old.src_size - 1)
+                appended = src.read(1) == b"\n"
+            if appended:
+                start_byte, start_line = old.src_size, old.n_lines
+            else:
+                old.close()
+                old = None
+        print(f"Indicizzazione di {file_name} dal byte {start_byte}...", flush=True)
+
+        offsets = tempfile.TemporaryFile(dir=tmpdir)
+        if old is not None:
+            offsets.write(old.line_offsets[:old.n_lines])
+        runs = []
+        postings = {}
+        segment_bytes = 0
+        line_offsets = array("Q")
+        pos, line_no = start_byte, start_line
+        src.seek(start_byte)
+        for raw in src:
+            if pos >= st.st_size:
+                # righe aggiunte durante la build: le indicizzerà il prossimo aggiornamento
+                break
+            line_offsets.append(pos)
+            tokens = _tokenize(raw.decode("utf-8", errors="replace"))
+            for token in tokens:
+                lines = postings.get(token)
+                if lines is None:
+                    lines = postings[token] = array("I")
+                    segment_bytes += INDEX_TOKEN_OVERHEAD + len(token)
+                lines.append(line_no)
+            segment_bytes += 4 * len(tokens)
+            pos += len(raw)
+            line_no += 1
+            if len(line_offsets) >= 1_000_000:
+                line_offsets.tofile(offsets)
+                del line_offsets[:]
+            if segment_bytes >= INDEX_SEGMENT_BYTES:
+                runs.append(_write_run(postings, tmpdir))
+                postings.clear()
+                segment_bytes = 0
+        line_offsets.append(pos)
+        line_offsets.tofile(offsets)
+        if postings:
+            runs.append(_write_run(postings, tmpdir))
+            postings.clear()
+        tail_crc = _tail_crc(src, st.st_size)
+
+    # Fusione dei segmenti (l'indice esistente è il primo segmento): vocabolario
+    # e offset vanno su file temporanei, in RAM resta solo un blocco alla volta
+    sources = [old.iter_tokens()] if old is not None else []
+    sources += [_read_run(f) for f in runs]
+    vocab_file = tempfile.TemporaryFile(dir=tmpdir)
+    starts_file = tempfile.TemporaryFile(dir=tmpdir)
+    post_starts_file = tempfile.TemporaryFile(dir=tmpdir)
+    post_file = tempfile.TemporaryFile(dir=tmpdir)
+    token_starts = array("Q", [0])
+    post_starts = array("Q", [0])
+    vocab_len = 0
+    n_postings = 0
+    n_tokens = 0
+    for token, group in groupby(heapq.merge(*sources, key=itemgetter(0)), key=itemgetter(0)):
+        data = token.encode("utf-8") + b"\n"
+        vocab_file.write(data)
+        vocab_len += len(data)
+        token_starts.append(vocab_len)
+        for _, lines in group:
+            lines.tofile(post_file)
+            n_postings += len(lines)
+        post_starts.append(n_postings)
+        n_tokens += 1
+        if len(token_starts) >= 1_000_000:
+            token_starts.tofile(starts_file)
+            post_starts.tofile(post_starts_file)
+            del token_starts[:], post_starts[:]
+    token_starts.tofile(starts_file)
+    post_starts.tofile(post_starts_file)
+    n_lines = line_no
+
+    tmp_index = index_file + ".tmp"
+    with open(tmp_index, "wb") as out:
+        out.write(_INDEX_HEADER.pack(_INDEX_MAGIC, st.st_size, st.st_mtime_ns, n_lines, n_tokens,
+                                     vocab_len, n_postings, tail_crc))
+        for f in (offsets, starts_file, post_starts_file, vocab_file):
+            f.seek(0)
+            shutil.copyfileobj(f, out)
+        out.write(b"\0" * (_pad8(vocab_len) - vocab_len))
+        post_file.seek(0)
+        shutil.copyfileobj(post_file, out)
+    if old is not None:
+        old.close()
+    os.replace(tmp_index, index_file)
+    for f in runs + [offsets, starts_file, post_starts_file, vocab_file, post_file]:
+        f.close()
+    print(f"Indice {index_file} pronto: {n_lines} righe, {n_tokens} token, "
+          f"{n_postings} posting in {time.time() - started:.1f}s", flush=True)
+
+def _rebuild_index_worker():
+    try:
+        build_index()
+    except Exception as e:
+        print("Errore nella costruzione dell'indice:", e, flush=True)
+
+def get_index():
+    """
+    Restituisce l'indice di FILE_NAME se aggiornato, altrimenti None.
+    Se l'indice esiste ma è vecchio avvia l'aggiornamento in background:
+    nel frattempo le ricerche usano la scansione completa.
+    """
+    global _index_cache, _index_build_thread
+    if not os.path.isfile(INDEX_FILE):
+        return None
+    st = os.stat(FILE_NAME)
+    with _index_lock:
+        try:
+            index_mtime_ns = os.stat(INDEX_FILE).st_mtime_ns
+            if _index_cache is None or _index_cache.index_mtime_ns != index_mtime_ns:
+                _index_cache = SearchIndex(INDEX_FILE)
+        except (OSError, ValueError) as e:
+            print("Indice non utilizzabile:", e, flush=True)
+            _index_cache = None
+        if _index_cache is not None and _index_cache.is_fresh(st):
+            return _index_cache
+        if _index_build_thread is None or not _index_build_thread.is_alive():
+            print("Indice non aggiornato: ricostruzione in background.", flush=True)
+            _index_build_thread = threading.Thread(target=_rebuild_index_worker, daemon=True)
+            _index_build_thread.start()
+    return None
+
+def index_search(keywords, cancel=None):
+    """
+    Cerca tramite l'indice le righe che contengono tutte le keyword.
+    Restituisce None se l'indice non è disponibile o non è utile per la query.
+    """
+    index = get_index()
+    if index is None:
+        return None
+    candidates = index.candidate_lines(keywords, cancel)
+    if candidates is None:
+        return None
+    return index.iter_matches(FILE_NAME, candidates, keywords, cancel)
+
+# ------------------------------------------------------------------------------
+# RICERCA IN-PROCESS (senza rg/awk)
+# ------------------------------------------------------------------------------
+def keyword_pattern(keyword):
+    """
+    Compila `keyword` come pattern letterale bytes case-insensitive.
+    re.IGNORECASE sui bytes vale solo per l'ASCII, quindi le lettere con
+    maiuscola/minuscola diventano alternative esplicite in UTF-8.
+    """
+    parts = []
+    for ch in keyword:
+        variants = sorted({v for v in (ch, ch.lower(), ch.upper()) if len(v) == 1})
+        if len(variants) == 1:
+            parts.append(re.escape(ch.encode("utf-8")))
+        else:
+            parts.append(b"(?:" + b"|".join(re.escape(v.encode("utf-8")) for v in variants) + b")")
+    return re.compile(b"".join(parts))
+
+class SearchCancelled(Exception):
+    """Ricerca interrotta perché ha superato QUERY_TIMEOUT."""
+
+def scan_range(data, patterns, start, end, cancel=None):
+    """
+    Scansiona data[start:end] (start a inizio riga) e restituisce le righe che
+    soddisfano tutti i pattern. Il primo pattern guida la scansione, gli altri
+    vengono verificati solo sulla riga trovata: un solo passaggio sul file.
+    Il file viene percorso a blocchi di SCAN_BLOCK byte allineati alle righe,
+    controllando `cancel` tra un blocco e l'altro.
+    """
+    first, rest = patterns[0], patterns[1:]
+    pos = start
+    while pos < end:
+        if cancel is not None and cancel.is_set():
+            raise SearchCancelled()
+        block_end = data.find(b"\n", min(pos + SCAN_BLOCK, end), end)
+        block_end = end if block_end == -1 else block_end + 1
+        while pos < block_end:
+            m = first.search(data, pos, block_end)
+            if m is None:
+                break
+            line_start = data.rfind(b"\n", pos, m.start()) + 1 or pos
+            line_end = data.find(b"\n", m.end(), block_end)
+            if line_end == -1:
+                line_end = block_end
+            if all(p.search(data, line_start, line_end) for p in rest):
+                yield data[line_start:line_end].decode("utf-8", errors="replace").rstrip("\r")
+            pos = line_end + 1
+        pos = max(pos, block_end)
+
+def scan_file(keywords, cancel=None):
+    """
+    Legge FILE_NAME una sola volta via mmap e restituisce, man mano che le
+    trova, le righe che contengono (AND) tutte le keyword (case-insensitive).
+    """
+    # la keyword più lunga è di solito la più selettiva: guida la scansione
+    patterns = [keyword_pattern(kw) for kw in sorted(keywords, key=len, reverse=True)]
+    with open(FILE_NAME, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from scan_range(data, patterns, 0, len(data), cancel)
+
+# ------------------------------------------------------------------------------
+# SCANSIONE PARALLELA A SHARD
+# ------------------------------------------------------------------------------
+_scan_pool = None
+_scan_pool_lock = threading.Lock()
+
+def _scan_shard(file_name, keywords, start, end):
+    """
+    Eseguita nei processi del pool: mappa il file (le pagine sono condivise
+    tramite la page cache) e restituisce le righe trovate in [start, end).
+    """
+    patterns = [keyword_pattern(kw) for kw in sorted(keywords, key=len, reverse=True)]
+    with open(file_name, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return list(scan_range(data, patterns, start, end))
+
+def get_scan_pool():
+    """
+    Pool di processi per la scansione parallela, creato una sola volta.
+    Va creato prima di avviare altri thread (fork di un processo con thread attivi).
+    """
+    global _scan_pool
+    with _scan_pool_lock:
+        if _scan_pool is None:
+            _scan_pool = multiprocessing.Pool(SCAN_PROCESSES)
+        return _scan_pool
+
+def parallel_scan_file(keywords, cancel=None):
+    """
+    Divide FILE_NAME in shard di SHARD_SIZE byte allineati alle righe e li
+    scansiona nel pool di processi. I risultati vengono restituiti nell'ordine
+    del file; al massimo SHARD_WINDOW shard per processo sono in volo, così la
+    memoria resta limitata anche se la ricerca viene interrotta.
+    """
+    pool = get_scan_pool()
+    pending = deque()
+    with open(FILE_NAME, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            pos = 0
+            while pos < size or pending:
+                while pos < size and len(pending) < SCAN_PROCESSES * SHARD_WINDOW:
+                    end = data.find(b"\n", min(pos + SHARD_SIZE, size), size)
+                    end = size if end == -1 else end + 1
+                    pending.append(pool.apply_async(_scan_shard, (FILE_NAME, keywords, pos, end)))
+                    pos = end
+                if cancel is not None and cancel.is_set():
+                    raise SearchCancelled()
+                result = pending.popleft()
+                while not result.ready():
+                    result.wait(0.5)
+                    if cancel is not None and cancel.is_set():
+                        raise SearchCancelled()
+                yield from result.get()
+
+def scan(keywords, cancel=None):
+    """Scansione completa: parallela se ci sono più core e il file è grande."""
+    if SCAN_PROCESSES > 1 and os.path.getsize(FILE_NAME) > SHARD_SIZE:
+        return parallel_scan_file(keywords, cancel)
+    return scan_file(keywords, cancel)
+
+def _rg_chain_count(file_name, keywords):
+    """
+    Vecchia pipeline "rg | rg | ..." (una rg per keyword), usata solo come
+    riferimento nel benchmark. Restituisce il numero di righe trovate.
+    """
+    rg = ["rg", "-a", "-uu", "--no-config", "--no-mmap", "--color=never", "-i", "-F"]
+    procs = [subprocess.Popen(rg + ["--", keywords[0], file_name], stdout=subprocess.PIPE)]
+    for kw in keywords[1:]:
+        procs.append(subprocess.Popen(rg + ["--", kw], stdin=procs[-1].stdout, stdout=subprocess.PIPE))
+        procs[-2].stdout.close()
+    count = sum(1 for _ in procs[-1].stdout)
+    for proc in procs:
+        proc.wait()
+    return count
+
+def benchmark(size_mb=2048, keywords=("mario", "rossi", "roma")):
+    """
+    Genera un file sintetico di `size_mb` MB e confronta la pipeline rg, la
+    scansione su un solo processo e quella parallela a shard.
+    Uso: python3 fbquery_bot.py --bench [MB]
+    """
+    global FILE_NAME
+    import random
+    names = ["Mario", "Rossi", "Luigi", "Bianchi", "Giulia", "Verdi", "Anna", "Esposito",
+             "Roma", "Milano", "Napoli", "Torino", "Città", "Forlì"]
+    rnd = random.Random(42)
+    block = "".join(f"39{rnd.randint(10**9, 10**10 - 1)}:{rnd.randint(10**8, 10**9)}:"
+                    f"{rnd.choice(names)}:{rnd.choice(names)}:{rnd.choice('MF')}:{rnd.choice(names)}::"
+                    f"{rnd.randint(1, 12)}/{rnd.randint(1, 28)}/{rnd.randint(1950, 2005)}\n"
+                    for _ in range(50_000)).encode("utf-8")
+    tmpdir = tempfile.mkdtemp(prefix="fbquery_bench_")
+    bench_file = os.path.join(tmpdir, "bench.txt")
+    with open(bench_file, "wb") as f:
+        for _ in range(max(1, size_mb * 1024 * 1024 // len(block))):
+            f.write(block)
+    old_file, FILE_NAME = FILE_NAME, bench_file
+    try:
+        print(f"File sintetico: {os.path.getsize(bench_file) / 2**20:.0f} MB, "
+              f"keyword: {' '.join(keywords)}, processi: {SCAN_PROCESSES}", flush=True)
+        runs = [("scan 1 processo", lambda: sum(1 for _ in scan_file(list(keywords)))),
+                ("scan parallela", lambda: sum(1 for _ in parallel_scan_file(list(keywords))))]
+        if shutil.which("rg"):
+            runs.insert(0, ("rg | rg | rg", lambda: _rg_chain_count(bench_file, list(keywords))))
+        for name, func in runs:
+            started = time.time()
+            count = func()
+            elapsed = time.time() - started
+            print(f"{name:<18} {elapsed:8.2f}s  {os.path.getsize(bench_file) / 2**20 / elapsed:8.1f} MB/s  "
+                  f"{count} righe", flush=True)
+    finally:
+        FILE_NAME = old_file
+        shutil.rmtree(tmpdir)
+
+# ------------------------------------------------------------------------------
+# CACHE DEI RISULTATI
+# ------------------------------------------------------------------------------
+def normalize_keywords(keywords):
+    return tuple(sorted({kw.lower() for kw in keywords}))
+
+def file_version(file_name=None):
+    """Identifica la versione di un file: cambia se viene sostituito o modificato."""
+    st = os.stat(file_name or FILE_NAME)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class ResultCache:
+    """
+    Cache LRU dei risultati completi delle ricerche, limitata a `max_bytes`.
+    La chiave è l'insieme normalizzato delle keyword; ogni voce ricorda la
+    versione di FILE_NAME da cui è stata calcolata, così un file cambiato
+    invalida la cache. Se `path` è impostato la cache sopravvive ai riavvii.
+    """
+    def __init__(self, max_bytes, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.entries = OrderedDict()  # keywords -> (versione, righe, byte)
+        self.size = 0
+        self.hits = 0
+        self.subset_hits = 0
+        self.misses = 0
+        self.last_save = time.time()
+        self.lock = threading.Lock()
+
+    def lookup(self, keywords, version):
+        """
+        Restituisce (righe, keyword ancora da verificare) oppure None.
+        Se la query esatta non è in cache ma lo è un suo sottoinsieme di
+        keyword, basta filtrare quel risultato con le keyword mancanti.
+        """
+        with self.lock:
+            entry = self.entries.get(keywords)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(keywords)
+                self.hits += 1
+                return entry[1], ()
+            wanted = set(keywords)
+            best = None
+            for key, (entry_version, lines, _) in self.entries.items():
+                if entry_version == version and wanted.issuperset(key) and \
+                        (best is None or len(lines) < len(best[1])):
+                    best = (key, lines)
+            if best is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best[0])
+            self.subset_hits += 1
+            return best[1], tuple(sorted(wanted.difference(best[0])))
+
+    def store(self, keywords, version, lines):
+        size = sum(len(line) for line in lines) + CACHE_LINE_OVERHEAD * (len(lines) + 1)
+        if size > CACHE_MAX_ENTRY_BYTES:
+            return
+        with self.lock:
+            # le voci calcolate su versioni precedenti del file non servono più
+            for key in [k for k, e in self.entries.items() if e[0] != version or k == keywords]:
+                self.size -= self.entries.pop(key)[2]
+            self.entries[keywords] = (version, tuple(lines), size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+            if self.path and time.time() - self.last_save >= CACHE_SAVE_INTERVAL:
+                self._save()
+
+    def _save(self):
+        self.last_save = time.time()
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(list(self.entries.items()), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print("Errore nel salvataggio della cache:", e, flush=True)
+
+    def save(self):
+        if self.path:
+            with self.lock:
+                self._save()
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                items = pickle.load(f)
+        except Exception as e:
+            print("Errore nel caricamento della cache:", e, flush=True)
+            return
+        version = file_version() if os.path.isfile(FILE_NAME) else None
+        with self.lock:
+            for key, entry in items:
+                if entry[0] == version:
+                    self.entries[key] = entry
+                    self.size += entry[2]
+            while self.size > self.max_bytes:
+                _, (_, _, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+        print(f"Cache caricata: {len(self.entries)} ricerche.", flush=True)
+
+    def stats(self):
+        with self.lock:
+            return (f"Cache: {len(self.entries)} ricerche, {self.size // 1024} KiB, "
+                    f"hit {self.hits}, hit da sottoinsieme {self.subset_hits}, miss {self.misses}")
+
+result_cache = ResultCache(CACHE_MAX_BYTES, CACHE_FILE)
+
+def _cache_results(keywords, version, results):
+    """
+    Restituisce i risultati così come arrivano e, se la ricerca arriva fino
+    in fondo, li salva in cache. Una ricerca interrotta o sostituita non
+    viene salvata; una troppo grande smette di essere raccolta.
+    """
+    collected = []
+    size = 0
+    for line in results:
+        if collected is not None:
+            size += len(line) + CACHE_LINE_OVERHEAD
+            if size > CACHE_MAX_ENTRY_BYTES:
+                collected = None
+            else:
+                collected.append(line)
+        yield line
+    if collected is not None:
+        result_cache.store(keywords, version, collected)
+
+def _filter_lines(lines, keywords):
+    patterns = [keyword_pattern(kw) for kw in keywords]
+    for line in lines:
+        data = line.encode("utf-8")
+        if all(p.search(data) for p in patterns):
+            yield line
+
+def search_lines(keywords, cancel=None):
+    """
+    Restituisce le righe di FILE_NAME che contengono tutte le keyword:
+    dalla cache se possibile, poi tramite l'indice se aggiornato, altrimenti
+    con la scansione completa.
+    È un generatore: la ricerca parte alla prima riga richiesta, quindi
+    dentro stream_results e sotto il suo QUERY_TIMEOUT.
+    """
+    key = normalize_keywords(keywords)
+    version = file_version()
+    cached = result_cache.lookup(key, version)
+    if cached is not None:
+        lines, extra = cached
+        if not extra:
+            yield from lines
+        else:
+            yield from _cache_results(key, version, _filter_lines(lines, extra))
+        return
+    try:
+        lines = index_search(keywords, cancel)
+    except SearchCancelled:
+        raise
+    except Exception as e:
+        print("Errore nella ricerca tramite indice:", e, flush=True)
+        lines = None
+    if lines is None:
+        lines = scan(keywords, cancel)
+    yield from _cache_results(key, version, lines)
+
+def _prepend(first, rest):
+    try:
+        yield first
+        yield from rest
+    finally:
+        # chiude anche il generatore interno (mmap e shard della scansione)
+        close = getattr(rest, "close", None)
+        if close is not None:
+            close()
+
+def deliver_results(chat_id, results):
+    """
+    Invia i risultati man mano che arrivano: il buffer viene spedito appena
+    raggiunge la dimensione di un messaggio Telegram, oppure da un timer
+    RESULT_FLUSH_SECONDS dopo la prima riga in attesa, anche se la scansione
+    non trova altro. La memoria resta costante. Si ferma dopo MAX_HITS righe o
+    MAX_RESULT_BYTES byte e restituisce (iteratore con i risultati rimanenti,
+    oppure None se sono finiti; righe inviate).
+    """
+    buffer = []
+    buffered = 0
+    hits = 0
+    sent_bytes = 0
+    lock = threading.Lock()
+    timer = None
+    done = False
+
+    def flush():
+        # da chiamare con `lock` acquisito
+        nonlocal buffer, buffered, timer
+        if timer is not None:
+            timer.cancel()
+            timer = None
+        if buffer:
+            # Aggiunge una riga vuota tra ogni riga di output
+            send_long_message(chat_id, "\n\n".join(buffer))
+            buffer = []
+            buffered = 0
+
+    def flush_late():
+        with lock:
+            if not done:
+                flush()
+
+    results = iter(results)
+    try:
+        for line in results:
+            line = strip_ansi_codes(line)
+            with lock:
+                if buffer and buffered + len(line) + 2 > MESSAGE_CHUNK:
+                    flush()
+                buffer.append(line)
+                buffered += len(line) + 2
+                hits += 1
+                sent_bytes += len(line) + 2
+                limit = hits >= MAX_HITS or sent_bytes >= MAX_RESULT_BYTES
+                if buffered >= MESSAGE_CHUNK or limit:
+                    flush()
+                elif timer is None:
+                    timer = threading.Timer(RESULT_FLUSH_SECONDS, flush_late)
+                    timer.daemon = True
+                    timer.start()
+            if limit:
+                for line in results:
+                    return _prepend(line, results), hits
+                return None, hits
+        with lock:
+            flush()
+    finally:
+        # dopo un errore o un'interruzione il timer non deve più inviare nulla
+        with lock:
+            done = True
+            if timer is not None:
+                timer.cancel()
+    if hits == 0:
+        send_message(chat_id, "Nessun risultato trovato.")
+    return None, hits
+
+def take_pending(chat_id):
+    """
+    Toglie e restituisce la ricerca sospesa di `chat_id` (o None).
+    """
+    with pending_lock:
+        pending = pending_results.pop(chat_id, None)
+    if pending is not None:
+        pending[2].cancel()
+    return pending
+
+def store_pending(chat_id, remaining, cancel):
+    """
+    Sospende i risultati rimanenti di `chat_id` fino al prossimo /more; dopo
+    PENDING_RESULTS_TTL secondi il generatore viene chiuso e scartato.
+    """
+    timer = threading.Timer(PENDING_RESULTS_TTL, expire_pending, (chat_id, remaining))
+    timer.daemon = True
+    with pending_lock:
+        old = pending_results.pop(chat_id, None)
+        pending_results[chat_id] = (remaining, cancel, timer)
+    if old is not None:
+        old[2].cancel()
+        old[0].close()
+    timer.start()
+
+def expire_pending(chat_id, remaining):
+    with pending_lock:
+        pending = pending_results.get(chat_id)
+        if pending is None or pending[0] is not remaining:
+            return
+        del pending_results[chat_id]
+    remaining.close()
+
+def send_more_results(chat_id):
+    """
+    Continua la ricerca sospesa di `chat_id` (comando /more).
+    """
+    pending = take_pending(chat_id)
+    if pending is None:
+        send_message(chat_id, "Nessuna ricerca in sospeso. Invia /start per una nuova ricerca.")
+        return
+    stream_results(chat_id, pending[0], pending[1])
+
+def stream_results(chat_id, results, cancel):
+    """
+    Invia una pagina di risultati entro QUERY_TIMEOUT secondi: allo scadere
+    `cancel` viene impostato e la scansione si interrompe.
+    """
+    timer = threading.Timer(QUERY_TIMEOUT, cancel.set)
+    timer.daemon = True
+    timer.start()
+    try:
+        remaining, hits = deliver_results(chat_id, results)
+    except SearchCancelled:
+        dispatcher.record_timeout()
+        send_message(chat_id, f"Ricerca interrotta: superato il tempo massimo di {QUERY_TIMEOUT} secondi.")
+        return
+    except OSError as e:
+        send_message(chat_id, f"Errore nell'esecuzione della ricerca:\n{e}")
+        return
+    finally:
+        timer.cancel()
+    if remaining is not None:
+        store_pending(chat_id, remaining, cancel)
+        send_message(chat_id, f"Mostrati {hits} risultati: invia /more per i successivi.")
+
 def process_search(chat_id, keywords_text):
     """
-    Esegue la ricerca sul file fb_italy.txt utilizzando ripgrep e awk,
+    Esegue la ricerca sul file fb_italy.txt (indice o scansione in-process)
     e invia l'output al chat_id. Tra ogni riga viene inserita una riga vuota
     per migliorarne la suddivisione.
     """
@@ -64,42 +954,102 @@ def process_search(chat_id, keywords_text):
         send_message(chat_id, f"Errore: il file {FILE_NAME} non esiste nella cartella corrente!")
         return
 
-    # ------------------------------------------------------------------------------
-    # 1) COSTRUZIONE DELLA PIPELINE DI RIPGREP PER RICERCA “AND” (case-insensitive)
-    # ------------------------------------------------------------------------------
-    command = f'rg -a -uu --no-config --no-mmap --color=never -i "{keywords[0]}" "{FILE_NAME}"'
-    for kw in keywords[1:]:
-        command += f' | rg -a -uu --no-config --no-mmap --color=never -i "{kw}"'
-
-    # ------------------------------------------------------------------------------
-    # 2) SCRIPT AWK PER FORMATTARE L'OUTPUT SENZA COLORAZIONE
-    # ------------------------------------------------------------------------------
-    # In questo caso lo script AWK si limita a stampare le righe così come sono.
-    awk_script = r'''
-BEGIN {
-  nKeys = split(keywords, kwArray, " ");
-}
-{
-  print $0;
-}
-'''
-
-    full_command = f'{command} | awk -F ":" -v keywords="{ " ".join(keywords) }" \'{awk_script}\''
-    
     header = f"\nCerco nel file '{FILE_NAME}' le righe contenenti (AND) tutte le keyword (case-insensitive): {' '.join(keywords)}\n"
     send_message(chat_id, header)
 
-    try:
-        result = subprocess.check_output(full_command, shell=True, universal_newlines=True, stderr=subprocess.STDOUT)
-        result_clean = strip_ansi_codes(result)
-        if not result_clean.strip():
-            send_message(chat_id, "Nessun risultato trovato.")
-        else:
-            # Aggiunge una riga vuota tra ogni riga di output
-            result_with_spaces = "\n\n".join(result_clean.splitlines())
-            send_long_message(chat_id, result_with_spaces)
-    except subprocess.CalledProcessError as e:
-        send_message(chat_id, f"Errore nell'esecuzione della ricerca:\n{e.output}")
+    # una nuova ricerca sostituisce quella eventualmente sospesa
+    old = take_pending(chat_id)
+    if old is not None:
+        old[0].close()
+    cancel = threading.Event()
+    stream_results(chat_id, search_lines(keywords, cancel), cancel)
+
+# ------------------------------------------------------------------------------
+# DISPATCHER DELLE RICERCHE
+# ------------------------------------------------------------------------------
+class SearchDispatcher:
+    """
+    Esegue le ricerche su un pool di SEARCH_WORKERS thread, così il polling
+    non si blocca. Ogni chat ha la sua coda: le richieste della stessa chat
+    vengono eseguite in ordine, una alla volta, mentre chat diverse procedono
+    in parallelo fino al limite globale di worker.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.queues = {}          # chat_id -> deque di (funzione, argomenti, istante di accodamento)
+        self.ready = queue.Queue()  # chat con richieste in attesa di un worker
+        self.running = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            th = threading.Thread(target=self._worker, name=f"search-{i}", daemon=True)
+            th.start()
+            self.threads.append(th)
+
+    def submit(self, chat_id, func, *args):
+        """
+        Accoda una richiesta per `chat_id`. Restituisce False se la coda della
+        chat è piena.
+        """
+        with self.lock:
+            q = self.queues.get(chat_id)
+            if q is None:
+                q = self.queues[chat_id] = deque()
+                self.ready.put(chat_id)
+            elif len(q) >= MAX_QUEUED_PER_CHAT:
+                return False
+            q.append((func, args, time.time()))
+            return True
+
+    def _worker(self):
+        while True:
+            chat_id = self.ready.get()
+            with self.lock:
+                func, args, queued_at = self.queues[chat_id].popleft()
+                self.running += 1
+            started = time.time()
+            try:
+                func(chat_id, *args)
+            except Exception as e:
+                print(f"Errore nella ricerca per {chat_id}:", e, flush=True)
+            finished = time.time()
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+                wait, run = started - queued_at, finished - started
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.total_run += run
+                self.max_run = max(self.max_run, run)
+                # la chat torna in coda solo se ha altre richieste
+                if self.queues[chat_id]:
+                    self.ready.put(chat_id)
+                else:
+                    del self.queues[chat_id]
+
+    def record_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def stats(self):
+        with self.lock:
+            queued = sum(len(q) for q in self.queues.values())
+            done = self.completed or 1
+            return (f"Ricerche in corso: {self.running}/{self.workers}\n"
+                    f"In coda: {queued} (chat: {len(self.queues)})\n"
+                    f"Completate: {self.completed}, interrotte per timeout: {self.timeouts}\n"
+                    f"Attesa in coda: media {self.total_wait / done:.2f}s, max {self.max_wait:.2f}s\n"
+                    f"Durata: media {self.total_run / done:.2f}s, max {self.max_run:.2f}s")
+
+dispatcher = SearchDispatcher(SEARCH_WORKERS)
 
 def handle_update(update):
     """
@@ -110,12 +1060,18 @@ def handle_update(update):
         chat_id = message["chat"]["id"]
         text = message.get("text", "")
         print(f"Ricevuto messaggio da {chat_id}: {text}", flush=True)
-        if text and text.split()[0] == "/start":
+        if text and text.split()[0] == "/more":
+            if not dispatcher.submit(chat_id, send_more_results):
+                send_message(chat_id, "Troppe richieste in coda, attendi la fine delle ricerche precedenti.")
+        elif text and text.split()[0] == "/stats":
+            send_message(chat_id, dispatcher.stats() + "\n" + result_cache.stats())
+        elif text and text.split()[0] == "/start":
             user_states[chat_id] = "awaiting_keywords"
             send_message(chat_id, "Benvenuto!\nInserisci le parole chiave (separate da spazio):")
         elif chat_id in user_states and user_states[chat_id] == "awaiting_keywords":
-            process_search(chat_id, text)
             user_states[chat_id] = None
+            if not dispatcher.submit(chat_id, process_search, text):
+                send_message(chat_id, "Troppe richieste in coda, attendi la fine delle ricerche precedenti.")
         else:
             send_message(chat_id, "Per iniziare, invia il comando /start.")
 
@@ -123,36 +1079,28 @@ def main():
     """
     Loop principale: il bot utilizza il metodo getUpdates per controllare i nuovi messaggi.
     """
+    if "--build-index" in sys.argv[1:]:
+        build_index()
+        return
+    if "--bench" in sys.argv[1:]:
+        args = sys.argv[sys.argv.index("--bench") + 1:]
+        benchmark(int(args[0]) if args else 2048)
+        return
     print("Avvio del bot... (Polling per aggiornamenti)", flush=True)
-    offset = None
-    while True:
+    if SCAN_PROCESSES > 1:
+        # il pool va creato prima di qualsiasi thread: get_index() può avviare
+        # la ricostruzione dell'indice in background, poi c'è il dispatcher
+        get_scan_pool()
+    if os.path.isfile(FILE_NAME):
+        get_index()
+    result_cache.load()
+    dispatcher.start()
+    # long polling: il client ripete subito la richiesta e gestisce gli errori di rete
+    for update in telegram.iter_updates(timeout=20):
         try:
-            print("Polling per aggiornamenti...", flush=True)
-            url = f"{BASE_URL}/getUpdates?timeout=20"
-            if offset:
-                url += f"&offset={offset}"
-            response = requests.get(url, timeout=30)
-            print("Richiesta getUpdates effettuata.", flush=True)
-            if response.status_code != 200:
-                print("Errore in getUpdates:", response.text, flush=True)
-                time.sleep(1)
-                continue
-
-            data = response.json()
-            if not data.get("ok"):
-                print("Risposta non ok:", data, flush=True)
-                time.sleep(1)
-                continue
-
-            updates = data.get("result", [])
-            if updates:
-                print(f"Ricevuti {len(updates)} aggiornamenti.", flush=True)
-            for update in updates:
-                offset = update["update_id"] + 1
-                handle_update(update)
+            handle_update(update)
         except Exception as e:
-            print("Errore nel polling:", e, flush=True)
-            time.sleep(1)
+            print("Errore nella gestione dell'aggiornamento:", e, flush=True)
 
 if __name__ == "__main__":
     main()
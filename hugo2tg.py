@@ -1,18 +1,31 @@
 #!/usr/bin/env python3
-import requests
-import time
 import os
 import subprocess
 import re
+import threading
+import time
+from collections import deque
 from datetime import datetime
+from telegram_client import TelegramClient, TelegramError
+import hugo_build
 
 # Inserisci qui il token del tuo bot (ottenuto tramite BotFather)
 TOKEN = ""
-BASE_URL = f"https://api.telegram.org/bot{TOKEN}/"
+telegram = TelegramClient(TOKEN)
 
 # URL base del blog
 BLOG_BASE_URL = "https://timrouter.dns.army/blog/"
 
+# Sorgenti del blog Hugo: i post vengono scritti in content/posts/<anno>/
+BLOG_PATH = "/home/pi/blog"
+POSTS_DIR = os.path.join(BLOG_PATH, "content/posts")
+# Attesa prima di avviare una build, per raccogliere i post inviati quasi insieme
+BUILD_COALESCE_SECONDS = 2
+# Script che scrive un post (riceve POST_TITLE, POST_TAGS, POST_KEYWORDS, POST_BODY e
+# POST_WRITE_ONLY=1 nell'ambiente: deve solo scrivere il post, la build la fa il bot).
+# Se manca o è "" il bot scrive da sé content/posts/<anno>/<data>-<slug>.md
+NEW_POST_SCRIPT = "/home/pi/blog/ask_new_post.sh"
+
 # ID del canale Telegram dove postare il link del nuovo post
 REPOST_CHANNEL_ID = -1002363443306  # Modifica con l'ID del tuo canale
 
@@ -25,18 +38,134 @@ STATE_AWAIT_BODY = "await_body"
 # Dizionario per memorizzare lo stato della conversazione per ogni chat_id
 conversations = {}
 
-def get_updates(offset=None, timeout=30):
-    url = BASE_URL + "getUpdates"
-    params = {'timeout': timeout}
-    if offset:
-        params['offset'] = offset
-    response = requests.get(url, params=params)
-    return response.json()
+# Messaggi in attesa di elaborazione per ogni chat_id: un thread per chat li
+# elabora in ordine, così il polling non aspetta mai process_message
+chat_queues = {}
+chat_queues_lock = threading.Lock()
+
+def front_matter(title, dt_local, tags):
+    tags_yaml = "[" + ",".join('"' + t.replace('"', '\\"') + '"' for t in tags) + "]"
+    title = title.replace('"', '\\"')
+    return f"""---
+title: "{title}"
+date: {dt_local.isoformat(timespec="seconds")}
+tags: {tags_yaml}
+---
+"""
+
+def write_post(data):
+    """
+    Scrive il post con NEW_POST_SCRIPT, se presente, altrimenti in
+    content/posts/<anno>/<data>-<slug>.md (come uboat_today_to_hugo.py), e
+    restituisce il link che avrà dopo la build. Non sovrascrive mai un post
+    dello stesso giorno con lo stesso slug: solleva FileExistsError.
+    """
+    dt_local = datetime.now().astimezone()
+    pub_date = dt_local.strftime("%Y-%m-%d")
+    year = pub_date[:4]
+    slug = data["keywords"] or "post"
+    link = f"{BLOG_BASE_URL}posts/{year}/{pub_date}-{slug}/"
+    post_dir = os.path.join(POSTS_DIR, year)
+    path = os.path.join(post_dir, f"{pub_date}-{slug}.md")
+    if os.path.exists(path):
+        raise FileExistsError(f"esiste già un post di oggi con lo slug '{slug}', scegli altre parole chiave")
+    if NEW_POST_SCRIPT and os.access(NEW_POST_SCRIPT, os.X_OK):
+        env = os.environ.copy()
+        env["POST_TITLE"] = data["title"]
+        env["POST_TAGS"] = data["tags"]
+        env["POST_KEYWORDS"] = data["keywords"]
+        env["POST_BODY"] = data["body"]
+        env["POST_WRITE_ONLY"] = "1"
+        subprocess.run([NEW_POST_SCRIPT], env=env, check=True)
+        return link
+    tags = [t.strip() for t in data["tags"].split(",") if t.strip()]
+    os.makedirs(post_dir, exist_ok=True)
+    with open(path, "x", encoding="utf-8") as f:
+        f.write(front_matter(data["title"], dt_local, tags) + "\n" + data["body"].rstrip() + "\n")
+    return link
+
+class BuildQueue:
+    """
+    Worker in background che scrive i post e rigenera il sito. I post che
+    arrivano mentre una build è in corso (o entro BUILD_COALESCE_SECONDS dal
+    primo) vengono pubblicati tutti con la build successiva: N post in coda
+    costano una sola rigenerazione di Hugo.
+    """
+    def __init__(self):
+        self.pending = []  # (chat_id, dati del post)
+        self.cond = threading.Condition()
+        self.building = 0  # post nella build in corso
+        self.builds = 0
+        self.last_duration = None
+        self.total_duration = 0.0
+        self.thread = None
+
+    def submit(self, chat_id, data):
+        """Accoda un post e restituisce quanti post sono in attesa di build."""
+        with self.cond:
+            self.pending.append((chat_id, dict(data)))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, name="hugo-build", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+            return len(self.pending) + self.building
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            time.sleep(BUILD_COALESCE_SECONDS)
+            with self.cond:
+                batch, self.pending = self.pending, []
+                self.building = len(batch)
+            try:
+                self._publish(batch)
+            finally:
+                with self.cond:
+                    self.building = 0
+
+    def _publish(self, batch):
+        written = []
+        for chat_id, data in batch:
+            try:
+                written.append((chat_id, write_post(data)))
+            except (OSError, subprocess.CalledProcessError) as e:
+                send_message(chat_id, f"Si è verificato un errore durante la creazione del post: {e}")
+        if not written:
+            return
+        try:
+            result = hugo_build.build(BLOG_PATH, caller="hugo2tg")
+        except (OSError, subprocess.CalledProcessError) as e:
+            for chat_id, _ in written:
+                send_message(chat_id, f"Post salvato, ma la rigenerazione del sito è fallita: {e}")
+            return
+        duration = result.duration
+        with self.cond:
+            self.builds += 1
+            self.last_duration = duration
+            self.total_duration += duration
+        print(f"Build Hugo completata in {duration:.1f}s per {len(written)} post")
+        for chat_id, link in written:
+            send_message(chat_id, f"Post creato e sito rigenerato con successo! ({duration:.0f}s)")
+            # Invia solo il link nudo sul canale
+            send_message(REPOST_CHANNEL_ID, link)
+
+    def status(self):
+        with self.cond:
+            text = f"Post in coda: {len(self.pending)}, in build: {self.building}. Build eseguite: {self.builds}"
+            if self.builds:
+                text += (f", ultima {self.last_duration:.1f}s, "
+                         f"media {self.total_duration / self.builds:.1f}s")
+            return text + "."
+
+build_queue = BuildQueue()
 
 def send_message(chat_id, text):
-    url = BASE_URL + "sendMessage"
-    payload = {"chat_id": chat_id, "text": text}
-    requests.post(url, data=payload)
+    try:
+        telegram.send_message(chat_id, text)
+    except TelegramError as e:
+        print(f"Errore nell'invio del messaggio a {chat_id}: {e}")
 
 def process_message(message):
     chat_id = message["chat"]["id"]
@@ -50,6 +179,10 @@ def process_message(message):
         send_message(chat_id, "Inserisci il titolo del post:")
         return
 
+    if text == "/status":
+        send_message(chat_id, build_queue.status())
+        return
+
     if text == "/cancel":
         if chat_id in conversations:
             del conversations[chat_id]
@@ -82,31 +215,9 @@ def process_message(message):
 
     elif state == STATE_AWAIT_BODY:
         if text == "/done":
-            data = conv["data"]
-            send_message(chat_id, "Creazione del post in corso, attendi prego...")
-
-            env = os.environ.copy()
-            env["POST_TITLE"] = data["title"]
-            env["POST_TAGS"] = data["tags"]
-            env["POST_KEYWORDS"] = data["keywords"]
-            env["POST_BODY"] = data["body"]
-
-            try:
-                subprocess.run(["/home/pi/blog/ask_new_post.sh"], env=env, check=True)
-                send_message(chat_id, "Post creato e sito rigenerato con successo!")
-
-                # Costruisci il link finale del post
-                today = datetime.now().strftime("%Y-%m-%d")
-                year = today[:4]
-                slug = data["keywords"]
-                new_post_link = f"{BLOG_BASE_URL}posts/{year}/{today}-{slug}/"
-
-                # Invia solo il link nudo sul canale
-                send_message(REPOST_CHANNEL_ID, new_post_link)
-
-            except subprocess.CalledProcessError as e:
-                send_message(chat_id, f"Si è verificato un errore durante la creazione del post: {e}")
-
+            waiting = build_queue.submit(chat_id, conv["data"])
+            send_message(chat_id, f"Post in coda per la pubblicazione ({waiting} in attesa), "
+                                  "ti avviso quando il sito è rigenerato.")
             del conversations[chat_id]
 
         else:
@@ -119,16 +230,36 @@ def process_message(message):
     else:
         send_message(chat_id, "Stato sconosciuto. Invia /cancel per annullare e riprova.")
 
-def main():
-    offset = None
+def dispatch_message(message):
+    """Accoda il messaggio per la sua chat e avvia il thread della chat se non è attivo."""
+    chat_id = message["chat"]["id"]
+    with chat_queues_lock:
+        pending = chat_queues.get(chat_id)
+        if pending is not None:
+            pending.append(message)
+            return
+        chat_queues[chat_id] = deque([message])
+    threading.Thread(target=chat_worker, args=(chat_id,), daemon=True).start()
+
+def chat_worker(chat_id):
     while True:
-        updates = get_updates(offset)
-        if "result" in updates:
-            for update in updates["result"]:
-                offset = update["update_id"] + 1
-                if "message" in update:
-                    process_message(update["message"])
-        time.sleep(1)
+        with chat_queues_lock:
+            pending = chat_queues[chat_id]
+            if not pending:
+                del chat_queues[chat_id]
+                return
+            message = pending.popleft()
+        try:
+            process_message(message)
+        except Exception as e:
+            print(f"Errore nella gestione del messaggio da {chat_id}: {e}")
+
+def main():
+    # long polling: appena arriva una risposta si ripete la richiesta;
+    # gli errori di rete sono gestiti (con backoff) da iter_updates
+    for update in telegram.iter_updates(timeout=30):
+        if "message" in update:
+            dispatch_message(update["message"])
 
 if __name__ == "__main__":
     main()
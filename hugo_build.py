@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+hugo_build.py
+
+Build del blog Hugo condivisa da hugo2tg.py e uboat_today_to_hugo.py.
+
+- un lockfile (flock) nella cartella del blog impedisce che i due script
+  lancino Hugo nello stesso momento: la seconda build aspetta la prima;
+- un manifest dei file sorgente (percorso, dimensione, mtime) permette di
+  saltare la build quando nulla è cambiato dall'ultima riuscita, ad esempio
+  se nel frattempo l'altro script ha già rigenerato il sito;
+- quando un sorgente cambia Hugo rende comunque tutto il sito, ma in una
+  cartella di staging: in OUTPUT_DIR vengono spostati solo i file il cui
+  contenuto (sha256) è diverso dall'ultima pubblicazione e rimossi quelli
+  spariti. Le pagine invariate non vengono riscritte (niente scritture
+  inutili sulla SD, mtime e cache HTTP restano validi) e chi legge il sito
+  non vede mai una build a metà;
+- ogni build registra attesa del lock e durata in un file JSON lines.
+
+Uso da riga di comando: python3 hugo_build.py [cartella_blog] [--force]
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+BLOG_PATH     = "/home/pi/blog"
+HUGO_COMMAND  = ["hugo"]
+LOCK_FILE     = ".hugo_build.lock"
+MANIFEST_FILE = ".hugo_build.manifest"
+OUTPUT_MANIFEST = ".hugo_build.output"    # sha256 di ogni file pubblicato in OUTPUT_DIR
+STAGING_DIR   = ".hugo_build.staging"     # destinazione di Hugo prima della pubblicazione
+METRICS_FILE  = ".hugo_build_metrics.jsonl"
+OUTPUT_DIR    = "public"
+
+# Cartelle e file di configurazione che influenzano l'output di Hugo
+INPUT_DIRS   = ("content", "layouts", "static", "assets", "data", "i18n", "themes", "archetypes")
+CONFIG_FILES = ("hugo.toml", "hugo.yaml", "hugo.json", "config.toml", "config.yaml", "config.json")
+
+BuildResult = namedtuple("BuildResult", "skipped duration lock_wait changed removed", defaults=(0, 0))
+
+
+def input_fingerprint(blog_path):
+    """
+    Impronta dei sorgenti del sito: hash di percorso, dimensione e mtime di
+    ogni file. Basta uno stat per file, senza leggerne il contenuto.
+    """
+    h = hashlib.sha256()
+    paths = [os.path.join(blog_path, name) for name in CONFIG_FILES]
+    for name in INPUT_DIRS:
+        for root, dirs, files in os.walk(os.path.join(blog_path, name)):
+            dirs.sort()
+            paths.extend(os.path.join(root, f) for f in sorted(files))
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        h.update(f"{os.path.relpath(path, blog_path)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def publish_output(staging, output, manifest_path):
+    """
+    Porta in `output` la build appena fatta in `staging`: sposta solo i file
+    nuovi o con contenuto diverso e rimuove quelli non più generati (solo se
+    pubblicati da qui: i file aggiunti a mano restano). Restituisce
+    (file cambiati, file rimossi).
+    """
+    previous = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            previous = json.load(f)
+    current = {}
+    changed = 0
+    for root, dirs, files in os.walk(staging):
+        for name in files:
+            src = os.path.join(root, name)
+            rel = os.path.relpath(src, staging)
+            dst = os.path.join(output, rel)
+            digest = current[rel] = _file_sha256(src)
+            old = previous.get(rel)
+            if old is None and os.path.isfile(dst):
+                old = _file_sha256(dst)  # primo giro: confronta con quanto già pubblicato
+            if old == digest and os.path.isfile(dst):
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(src, dst)
+            changed += 1
+    removed = 0
+    for rel in previous.keys() - current.keys():
+        path = os.path.join(output, rel)
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            continue
+        # elimina anche le cartelle rimaste vuote (es. la pagina di un post cancellato)
+        parent = os.path.dirname(path)
+        while parent != os.path.normpath(output) and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(current, f, sort_keys=True)
+    os.replace(tmp, manifest_path)
+    return changed, removed
+
+
+def _record(blog_path, caller, result):
+    entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "caller": caller,
+             "skipped": result.skipped, "duration": round(result.duration, 3),
+             "lock_wait": round(result.lock_wait, 3),
+             "changed": result.changed, "removed": result.removed}
+    try:
+        with open(os.path.join(blog_path, METRICS_FILE), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError:
+        pass
+
+
+def build(blog_path=BLOG_PATH, caller="", force=False):
+    """
+    Rigenera il sito se i sorgenti sono cambiati dall'ultima build riuscita,
+    altrimenti non fa nulla: così una build già eseguita dall'altro script
+    non viene ripetuta. Hugo rende tutto in STAGING_DIR, poi in OUTPUT_DIR
+    vengono pubblicati solo i file cambiati (vedi publish_output).
+    Attende il lock se un'altra build è in corso. Solleva
+    subprocess.CalledProcessError se Hugo fallisce.
+    """
+    requested = time.time()
+    with open(os.path.join(blog_path, LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            lock_wait = time.time() - requested
+            manifest_path = os.path.join(blog_path, MANIFEST_FILE)
+            fingerprint = input_fingerprint(blog_path)
+            previous = None
+            if os.path.isfile(manifest_path):
+                with open(manifest_path, encoding="utf-8") as f:
+                    previous = f.read().strip()
+            if not force and previous == fingerprint and os.path.isdir(os.path.join(blog_path, OUTPUT_DIR)):
+                result = BuildResult(True, 0.0, lock_wait)
+            else:
+                started = time.time()
+                staging = os.path.join(os.path.abspath(blog_path), STAGING_DIR)
+                subprocess.run(HUGO_COMMAND + ["-s", blog_path, "-d", staging, "--cleanDestinationDir"],
+                               check=True)
+                changed, removed = publish_output(staging, os.path.join(blog_path, OUTPUT_DIR),
+                                                  os.path.join(blog_path, OUTPUT_MANIFEST))
+                result = BuildResult(False, time.time() - started, lock_wait, changed, removed)
+                tmp = manifest_path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(fingerprint + "\n")
+                os.replace(tmp, manifest_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    _record(blog_path, caller, result)
+    return result
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    res = build(args[0] if args else BLOG_PATH, caller="cli", force="--force" in sys.argv)
+    if res.skipped:
+        print("Nessuna modifica ai sorgenti: build saltata.")
+    else:
+        print(f"Build completata in {res.duration:.1f}s (attesa lock {res.lock_wait:.1f}s), "
+              f"{res.changed} file pubblicati, {res.removed} rimossi.")
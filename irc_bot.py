@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
+import asyncio
+import gzip
+import heapq
+import queue
+import shutil
 import socket
+import sqlite3
 import sys
 import re
 import time
@@ -7,7 +13,8 @@ import json
 import threading
 import os
 import struct
-import random
+from array import array
+from collections import deque
 
 # Configurazioni base
 SERVER   = "irc.libera.chat"
@@ -22,46 +29,997 @@ BOT_PASSWORD = "password"  # Sostituisci con la password registrata per il nick
 FILE_ALLOWED_USERS = ["nickname", "UtenteAutorizzato"]
 ADMINS            = ["nickname"]  # Solo questi potranno usare i comandi avanzati
 
+# Reti e canali seguiti dallo stesso processo: una connessione per rete, tutte
+# nello stesso event loop. Le statistiche sono separate per canale ("rete/canale").
+# "admins" e "file_users" valgono solo sulla propria rete (un nick non è lo
+# stesso utente su reti diverse): se mancano, nessuno è autorizzato.
+# "port" e "password" sono facoltative (valgono PORT e BOT_PASSWORD), come
+# "flood_penalty", "flood_bytes" e "flood_window" (vedi IRC_FLOOD_*).
+NETWORKS = [
+    {"name": "libera", "server": SERVER, "port": PORT, "nick": BOTNICK, "channels": [CHANNEL],
+     "admins": ADMINS, "file_users": FILE_ALLOWED_USERS},
+]
+
 # File per statistiche e log
-STATS_FILE    = "irc_bot_stats.json"
+STATS_DB      = "irc_bot_stats.db"     # SQLite (WAL), aggiornato a delta
+STATS_FILE    = "irc_bot_stats.json"   # vecchio formato: importato una volta in STATS_DB
+STATS_SNAPSHOT = "irc_bot_stats.snapshot.db"  # copia coerente di STATS_DB, per i backup
 LOG_FILE      = "irc_bot.log"
-SAVE_INTERVAL = 60  # secondi
+SAVE_INTERVAL = 10    # secondi tra due scritture dei delta delle statistiche
+SNAPSHOT_INTERVAL = 3600  # secondi tra due snapshot
+
+# Statistiche nel tempo (!top, !activity, !peak): finestre scorrevoli in memoria
+ROLLUP_MINUTES   = 60     # intervalli da un minuto conservati
+ROLLUP_HOURS     = 24     # intervalli da un'ora
+ROLLUP_DAYS      = 30     # intervalli da un giorno
+ROLLUP_MAX_USERS = 50000  # utenti seguiti (~1,7 KB ciascuno); oltre si scartano i meno recenti
+ROLLUP_TOP       = 5      # nick mostrati da !top
+ROLLUP_REFRESH   = 60     # secondi tra due ricalcoli della classifica di !top
+
+# Log: scritto da un thread dedicato, con flush a blocchi e rotazione compressa
+LOG_FLUSH_INTERVAL = 1.0                # secondi massimi prima che una riga arrivi su disco
+LOG_MAX_BYTES      = 10 * 1024 * 1024   # rotazione oltre questa dimensione...
+LOG_ROTATE_DAILY   = True               # ...e a ogni cambio di giorno
+LOG_BACKUPS        = 10                 # file .gz conservati
+LOG_QUEUE_SIZE     = 100000             # righe in attesa; oltre vengono scartate (e contate)
+LOG_CONSOLE        = True               # ripete il log anche su stdout
+# Traffico grezzo << / >>: "all" (tutto), "sample" (una riga ogni LOG_RAW_SAMPLE_EVERY) o "off"
+LOG_RAW            = "all"
+LOG_RAW_SAMPLE_EVERY = 100
 
 # Directory per file condivisi
 SHARED_DIR = "shared_files"          # File disponibili per download
 UPLOAD_DIR = os.path.join(SHARED_DIR, "uploaded")  # File inviati dagli utenti
 
-# Per il resume, salviamo i trasferimenti attivi
-# La chiave sarà (utente, filename, port)
-ACTIVE_DCC_TRANSFERS = {}
-
 # Range di porte per DCC (da aprire sul router: ad es. 50000-50100)
 DCC_PORT_MIN = 50000
 DCC_PORT_MAX = 50100
+DCC_TIMEOUT  = 60  # secondi di attesa per la connessione DCC
+DCC_ACCEPT_TIMEOUT = 15  # secondi di attesa del DCC ACCEPT dopo un nostro DCC RESUME
+# Byte inviati per ogni chiamata a sendfile: ogni blocco aggiorna l'offset del trasferimento
+DCC_SEND_SLICE = 4 * 1024 * 1024
+# Buffer (riutilizzato) per ogni upload in ricezione
+DCC_RECV_BUFFER = 256 * 1024
 
-def choose_dcc_port():
-    return random.randint(DCC_PORT_MIN, DCC_PORT_MAX)
+# Limiti del gestore dei trasferimenti DCC
+DCC_MAX_TRANSFERS  = 8     # trasferimenti contemporanei in totale
+DCC_MAX_PER_USER   = 2     # trasferimenti contemporanei per utente
+DCC_MAX_QUEUED     = 32    # richieste in attesa oltre i limiti
+DCC_RATE_TOTAL     = 4 * 1024 * 1024  # byte/s per tutti i trasferimenti (0 = nessun limite)
+DCC_RATE_PER_USER  = 1024 * 1024      # byte/s per utente (0 = nessun limite)
+DCC_RESUME_WINDOW  = 300   # secondi in cui un invio interrotto resta riprendibile (e la porta riservata)
 
-class IRCBot:
-    def __init__(self, server, port, channel, botnick):
-        self.server    = server
-        self.port      = port
-        self.channel   = channel
-        self.botnick   = botnick
-        self.ircsock   = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# Lunghezza massima di una riga IRC (512 byte + tag IRCv3): le righe più
+# lunghe vengono scartate, così il buffer di lettura resta limitato
+IRC_LINE_LIMIT = 8192 + 512
+
+# Invio verso il server: una riga IRC (con il prefisso ":nick!user@host "
+# aggiunto dal server e il \r\n) non può superare IRC_MAX_LINE byte
+IRC_MAX_LINE      = 512
+# Controllo del flood (RFC 1459, 8.10, usato con varianti da quasi tutti gli
+# ircd): ogni riga costa IRC_FLOOD_PENALTY secondi più uno ogni IRC_FLOOD_BYTES
+# byte, e il server chiude la connessione oltre ~10 secondi di anticipo
+IRC_FLOOD_PENALTY = 2.0
+IRC_FLOOD_BYTES   = 120
+IRC_FLOOD_WINDOW  = 8.0    # secondi di anticipo che ci concediamo (margine sui 10 del server)
+IRC_SEND_QUEUE    = 500    # righe in attesa; oltre si scartano i messaggi normali (non PONG e controllo)
+IRC_QUIT_TIMEOUT  = 10     # secondi concessi alla coda per svuotarsi prima del QUIT
+
+async def dcc_stream_file(conn, file_path, offset, filesize, progress=None, slice_size=DCC_SEND_SLICE):
+    """
+    Invia il file da `offset` a `filesize` sulla connessione DCC con
+    sendfile (zero-copy; asyncio ripiega su letture bufferizzate se il
+    trasporto non lo supporta), a blocchi di `slice_size` byte. Dopo ogni
+    blocco chiama `await progress(byte)`. Restituisce l'offset raggiunto.
+    """
+    loop = asyncio.get_running_loop()
+    current_offset = offset
+    with open(file_path, "rb") as f:
+        while current_offset < filesize:
+            count = min(slice_size, filesize - current_offset)
+            sent = await loop.sendfile(conn.transport, f, current_offset, count)
+            if not sent:
+                break  # il file si è accorciato nel frattempo
+            current_offset += sent
+            if progress:
+                await progress(sent)
+    return current_offset
+
+async def dcc_receive_file(sock, part_path, offset, filesize, progress=None):
+    """
+    Riceve il file sul socket DCC (non bloccante) e lo scrive in `part_path`
+    a partire da `offset`. Legge con recv_into in un buffer riutilizzato e,
+    dopo ogni lettura, conferma al mittente il totale ricevuto (ACK DCC a
+    32 bit): con letture grandi gli ACK si raggruppano da soli. Non si legge
+    mai oltre `filesize`, così i byte in eccesso non vengono né scritti né
+    confermati. Il mittente deve partire da `offset` (DCC RESUME/ACCEPT
+    già concordato). Il file viene
+    preallocato alla dimensione annunciata e, se il trasferimento si
+    interrompe, troncato ai byte ricevuti. Dopo ogni lettura chiama
+    `await progress(byte)`. Restituisce il totale ricevuto.
+    """
+    loop = asyncio.get_running_loop()
+    buf = bytearray(DCC_RECV_BUFFER)
+    view = memoryview(buf)
+    total_received = offset
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, filesize)
+            except OSError:
+                pass  # filesystem senza supporto: si scrive senza preallocare
+        os.lseek(fd, offset, os.SEEK_SET)
+        while total_received < filesize:
+            # wait_for su ogni operazione (asyncio.timeout richiede Python 3.11)
+            n = await asyncio.wait_for(loop.sock_recv_into(sock, view[:filesize - total_received]), DCC_TIMEOUT)
+            if not n:
+                break
+            written = 0
+            while written < n:
+                written += os.write(fd, view[written:n])
+            total_received += n
+            await asyncio.wait_for(loop.sock_sendall(sock, struct.pack("!I", total_received & 0xFFFFFFFF)),
+                                   DCC_TIMEOUT)
+            if progress:
+                await progress(n)
+    finally:
+        if total_received < filesize:
+            os.ftruncate(fd, total_received)
+        else:
+            os.fsync(fd)
+        os.close(fd)
+    return total_received
+
+# Sequenze di escape nei valori dei tag IRCv3
+_TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+def _unescape_tag(value):
+    if "\\" not in value:
+        return value
+    out = []
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == "\\":
+            i += 1
+            if i < len(value):
+                out.append(_TAG_ESCAPES.get(value[i], value[i]))
+        else:
+            out.append(c)
+        i += 1
+    return "".join(out)
+
+class IRCMessage:
+    """
+    Messaggio IRC già scomposto: tag IRCv3 (dict o None), prefisso, comando
+    (maiuscolo), parametri (l'ultimo può contenere spazi) e nick del mittente
+    (None se il prefisso è un server o manca).
+    """
+    __slots__ = ("tags", "prefix", "command", "params", "nick")
+
+    def __init__(self, tags, prefix, command, params, nick=None):
+        self.tags    = tags
+        self.prefix  = prefix
+        self.command = command
+        self.params  = params
+        self.nick    = nick
+
+    def __repr__(self):
+        return f"IRCMessage({self.tags!r}, {self.prefix!r}, {self.command!r}, {self.params!r})"
+
+def parse_message(line):
+    """
+    Scompone una riga IRC (RFC 1459 + tag IRCv3) con partition/split sulle
+    stringhe, senza espressioni regolari. Restituisce None se la riga non
+    contiene un comando.
+    """
+    tags = prefix = nick = None
+    if line[:1] == "@":
+        raw_tags, _, line = line[1:].partition(" ")
+        tags = {}
+        for item in raw_tags.split(";"):
+            if item:
+                key, _, value = item.partition("=")
+                tags[key] = _unescape_tag(value)
+        line = line.lstrip(" ")
+    if line[:1] == ":":
+        prefix, _, line = line.partition(" ")
+        prefix = prefix[1:]
+        nick, bang, _ = prefix.partition("!")
+        if not bang or not nick:
+            nick = None
+    # quello che segue " :" è un unico parametro (può contenere spazi)
+    line, sep, trailing = line.partition(" :")
+    params = line.split()
+    if not params:
+        return None
+    if sep:
+        params.append(trailing)
+    return IRCMessage(tags, prefix, params.pop(0).upper(), params, nick)
+
+class BotLog:
+    """
+    Log del bot. Il thread di rete si limita ad accodare (orario, messaggio);
+    un thread dedicato formatta le righe, le scrive a blocchi su un file
+    tenuto aperto, fa il flush al più ogni LOG_FLUSH_INTERVAL secondi e ruota
+    il file (per dimensione o cambio di giorno) comprimendo il vecchio in .gz.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self.raw_seen = 0
+        self.thread = threading.Thread(target=self.writer, name="irc-log", daemon=True)
+        self.thread.start()
+
+    def write(self, message):
+        try:
+            self.queue.put_nowait((time.time(), message))
+        except queue.Full:
+            self.dropped += 1
+
+    def raw(self, message):
+        """Traffico grezzo << / >>, registrato secondo LOG_RAW."""
+        if LOG_RAW == "off":
+            return
+        if LOG_RAW == "sample":
+            self.raw_seen += 1
+            if self.raw_seen % LOG_RAW_SAMPLE_EVERY:
+                return
+        self.write(message)
+
+    def close(self):
+        """Scrive le righe ancora in coda e chiude il file."""
+        self.queue.put(None)
+        self.thread.join(timeout=10)
+
+    def writer(self):
+        f = open(self.path, "a", encoding="utf-8")
+        day = time.strftime("%Y%m%d")
+        second, stamp = None, ""
+        last_flush = time.monotonic()
+        dirty = False
+        stop = False
+        while not stop:
+            try:
+                batch = [self.queue.get(timeout=LOG_FLUSH_INTERVAL)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < 1000:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in batch:
+                if item is None:
+                    stop = True
+                    continue
+                ts, message = item
+                if int(ts) != second:
+                    second, stamp = int(ts), time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+                lines.append(f"[{stamp}] {message}\n")
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(f"[{stamp}] {dropped} righe di log scartate (coda piena)\n")
+            if lines:
+                text = "".join(lines)
+                f.write(text)
+                if LOG_CONSOLE:
+                    sys.stdout.write(text)
+                dirty = True
+            now = time.monotonic()
+            if dirty and (stop or now - last_flush >= LOG_FLUSH_INTERVAL):
+                f.flush()
+                if LOG_CONSOLE:
+                    sys.stdout.flush()
+                last_flush, dirty = now, False
+            today = time.strftime("%Y%m%d")
+            if f.tell() >= LOG_MAX_BYTES or (LOG_ROTATE_DAILY and today != day and f.tell() > 0):
+                f.close()
+                self.rotate()
+                f = open(self.path, "a", encoding="utf-8")
+            day = today
+        f.close()
+
+    def rotate(self):
+        base = rotated = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}"
+        n = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+            rotated = f"{base}.{n}"
+            n += 1
+        os.replace(self.path, rotated)
+        # la compressione non deve fermare la scrittura del nuovo file
+        threading.Thread(target=self.compress, args=(rotated,), daemon=True).start()
+
+    def compress(self, rotated):
+        try:
+            with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.remove(rotated)
+            prefix = os.path.basename(self.path) + "."
+            folder = os.path.dirname(self.path) or "."
+            backups = sorted((os.path.join(folder, name) for name in os.listdir(folder)
+                              if name.startswith(prefix) and name.endswith(".gz")), key=os.path.getmtime)
+            for path in backups[:-LOG_BACKUPS]:
+                os.remove(path)
+        except OSError as e:
+            self.write(f"Errore nella compressione di {rotated}: {e}")
+
+class StatsStore:
+    """
+    Statistiche in SQLite (modalità WAL), un solo database per tutte le reti
+    e i canali, separate per `scope` ("rete/canale"). I contatori si
+    aggiornano in memoria e i soli incrementi (delta) di tutti gli scope
+    vengono scritti da flush() in un'unica transazione: un crash perde al più
+    gli ultimi SAVE_INTERVAL secondi, mai il file. All'apertura di uno scope
+    si leggono solo i suoi contatori globali, non l'elenco degli utenti.
+    """
+    COUNTERS = ("messages", "joins", "parts", "quits")
+
+    def __init__(self, path):
+        self.lock = threading.Lock()     # delta in memoria (thread di rete / flush)
+        self.db_lock = threading.Lock()  # la connessione è usata da più thread
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS counters (scope TEXT, name TEXT, value INTEGER NOT NULL,"
+                        " PRIMARY KEY (scope, name)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS users (scope TEXT, nick TEXT, messages INTEGER NOT NULL,"
+                        " PRIMARY KEY (scope, nick)) WITHOUT ROWID")
+        self.totals = {}         # scope -> {contatore: valore}
+        self.pending = {}        # (scope, contatore) -> delta
+        self.pending_users = {}  # (scope, nick) -> delta
+
+    def open_scope(self, scope, legacy=None):
+        """
+        Carica i contatori di `scope`. Se lo scope è nuovo e `legacy` ha dei
+        dati (le statistiche salvate con il solo nome del canale, prima del
+        supporto a più reti), questi vengono rinominati in `scope`.
+        """
+        with self.db_lock:
+            if legacy and not self.db.execute("SELECT 1 FROM counters WHERE scope = ? LIMIT 1",
+                                              (scope,)).fetchone():
+                self.db.execute("BEGIN")
+                self.db.execute("UPDATE counters SET scope = ? WHERE scope = ?", (scope, legacy))
+                self.db.execute("UPDATE users SET scope = ? WHERE scope = ?", (scope, legacy))
+                self.db.execute("COMMIT")
+            rows = self.db.execute("SELECT name, value FROM counters WHERE scope = ?", (scope,)).fetchall()
+        with self.lock:
+            totals = self.totals.setdefault(scope, dict.fromkeys(self.COUNTERS, 0))
+            for name, value in rows:
+                totals[name] = value
+        return totals
+
+    def incr(self, scope, name):
+        with self.lock:
+            self.totals[scope][name] += 1
+            key = (scope, name)
+            self.pending[key] = self.pending.get(key, 0) + 1
+
+    def message(self, scope, nick):
+        with self.lock:
+            self.totals[scope]["messages"] += 1
+            key = (scope, "messages")
+            self.pending[key] = self.pending.get(key, 0) + 1
+            key = (scope, nick)
+            self.pending_users[key] = self.pending_users.get(key, 0) + 1
+
+    def flush(self):
+        """Scrive i delta accumulati; restituisce False se non c'era nulla da scrivere."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            users, self.pending_users = self.pending_users, {}
+        if not pending and not users:
+            return False
+        with self.db_lock:
+            try:
+                self.db.execute("BEGIN")
+                self.db.executemany(
+                    "INSERT INTO counters VALUES (?, ?, ?)"
+                    " ON CONFLICT (scope, name) DO UPDATE SET value = value + excluded.value",
+                    [(scope, name, delta) for (scope, name), delta in pending.items()])
+                self.db.executemany(
+                    "INSERT INTO users VALUES (?, ?, ?)"
+                    " ON CONFLICT (scope, nick) DO UPDATE SET messages = messages + excluded.messages",
+                    [(scope, nick, delta) for (scope, nick), delta in users.items()])
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                # i delta non scritti tornano in coda per il prossimo flush
+                with self.lock:
+                    for key, delta in pending.items():
+                        self.pending[key] = self.pending.get(key, 0) + delta
+                    for key, delta in users.items():
+                        self.pending_users[key] = self.pending_users.get(key, 0) + delta
+                raise
+        return True
+
+    def user_count(self, scope):
+        with self.db_lock:
+            return self.db.execute("SELECT COUNT(*) FROM users WHERE scope = ?", (scope,)).fetchone()[0]
+
+    def snapshot(self, path):
+        """Copia coerente del database (backup API), sostituita in modo atomico."""
+        tmp = path + ".tmp"
+        dst = sqlite3.connect(tmp)
+        try:
+            with self.db_lock:
+                self.db.backup(dst)
+        finally:
+            dst.close()
+        os.replace(tmp, path)
+
+    def import_json(self, path, scope):
+        """Importa in `scope` le statistiche del vecchio file JSON, se lo scope è ancora vuoto."""
+        with self.db_lock:
+            if self.db.execute("SELECT 1 FROM counters WHERE scope = ? LIMIT 1", (scope,)).fetchone():
+                return False
+        with open(path, "r") as f:
+            old = json.load(f)
+        with self.lock:
+            totals = self.totals.setdefault(scope, dict.fromkeys(self.COUNTERS, 0))
+            for name in self.COUNTERS:
+                totals[name] += old.get(name, 0)
+                key = (scope, name)
+                self.pending[key] = self.pending.get(key, 0) + old.get(name, 0)
+            for nick, count in old.get("users", {}).items():
+                key = (scope, nick)
+                self.pending_users[key] = self.pending_users.get(key, 0) + count
+        self.flush()
+        os.replace(path, path + ".importato")
+        return True
+
+    def close(self):
+        self.flush()
+        with self.db_lock:
+            self.db.close()
+
+class RollupRing:
+    """
+    Contatore a finestra scorrevole: `size` intervalli da `unit` secondi in
+    un array circolare, con il totale della finestra tenuto aggiornato.
+    Gli intervalli scaduti si azzerano solo quando si avanza nel tempo.
+    """
+    __slots__ = ("unit", "size", "counts", "epoch", "total")
+
+    def __init__(self, unit, size):
+        self.unit = unit
+        self.size = size
+        self.counts = array("I", bytes(4 * size))
+        self.epoch = 0   # ultimo intervallo (tempo // unit) raggiunto
+        self.total = 0
+
+    def advance(self, now):
+        epoch = int(now // self.unit)
+        if epoch <= self.epoch:
+            return
+        if self.total:  # con totale zero tutti gli intervalli sono già a zero
+            steps = min(epoch - self.epoch, self.size)
+            for e in range(epoch - steps + 1, epoch + 1):
+                i = e % self.size
+                self.total -= self.counts[i]
+                self.counts[i] = 0
+        self.epoch = epoch
+
+    def add(self, now, amount=1):
+        self.advance(now)
+        self.counts[self.epoch % self.size] += amount
+        self.total += amount
+
+    def sum(self, now):
+        self.advance(now)
+        return self.total
+
+    def peak(self, now):
+        """(valore, inizio dell'intervallo in secondi) del massimo nella finestra."""
+        self.advance(now)
+        best = max(range(self.size), key=self.counts.__getitem__)
+        # epoch dell'intervallo che occupa la posizione `best`
+        epoch = self.epoch - (self.epoch - best) % self.size
+        return self.counts[best], epoch * self.unit
+
+class UserRollup:
+    """
+    Attività di un utente: messaggi per ora e giorno, join/part/quit solo per
+    giorno (servono a !activity, non alla classifica, e così la memoria per
+    utente resta contenuta). `nick` è l'ultima grafia vista del nick.
+    """
+    __slots__ = ("nick", "hours", "days", "joins", "parts", "quits", "last_seen")
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.hours = RollupRing(3600, ROLLUP_HOURS)
+        self.days = RollupRing(86400, ROLLUP_DAYS)
+        self.joins = RollupRing(86400, ROLLUP_DAYS)
+        self.parts = RollupRing(86400, ROLLUP_DAYS)
+        self.quits = RollupRing(86400, ROLLUP_DAYS)
+        self.last_seen = 0.0
+
+class Rollups:
+    """
+    Attività del canale nel tempo: messaggi, join, part e quit per minuto,
+    ora e giorno (RollupRing), più i messaggi per utente per ora e giorno
+    e i suoi join, part e quit per giorno. Gli utenti sono indicizzati per
+    nick minuscolo, come i membri del canale.
+    La memoria è fissata da ROLLUP_* e ROLLUP_MAX_USERS: a ogni refresh gli
+    utenti inattivi da più di ROLLUP_DAYS giorni (e i meno recenti oltre il
+    limite) vengono scartati. La classifica di !top si ricalcola nello
+    stesso refresh, ogni ROLLUP_REFRESH secondi; le risposte ai comandi
+    leggono solo valori già pronti.
+    """
+    KINDS = ("messages", "joins", "parts", "quits")
+
+    def __init__(self):
+        self.channel = {kind: (RollupRing(60, ROLLUP_MINUTES), RollupRing(3600, ROLLUP_HOURS),
+                               RollupRing(86400, ROLLUP_DAYS)) for kind in self.KINDS}
+        self.users = {}  # nick minuscolo -> UserRollup
+        self.top = []    # [(messaggi nelle ultime ROLLUP_HOURS ore, nick)]
+
+    def record(self, kind, nick, now=None):
+        now = now or time.time()
+        for ring in self.channel[kind]:
+            ring.add(now)
+        key = nick.lower()
+        user = self.users.get(key)
+        if user is None:
+            user = self.users[key] = UserRollup(nick)
+        user.nick = nick
+        user.last_seen = now
+        if kind == "messages":
+            user.hours.add(now)
+            user.days.add(now)
+        else:
+            getattr(user, kind).add(now)
+
+    def activity(self, nick, now=None):
+        """
+        (messaggi nell'ora corrente, nelle ultime ROLLUP_HOURS ore, negli ultimi
+        ROLLUP_DAYS giorni, join, part, quit negli ultimi ROLLUP_DAYS giorni) o None.
+        """
+        now = now or time.time()
+        user = self.users.get(nick.lower())
+        if user is None:
+            return None
+        hours = user.hours.sum(now)
+        return (user.hours.counts[user.hours.epoch % ROLLUP_HOURS], hours, user.days.sum(now),
+                user.joins.sum(now), user.parts.sum(now), user.quits.sum(now))
+
+    def peaks(self, now=None):
+        """Picchi di messaggi per minuto, ora e giorno nelle rispettive finestre."""
+        now = now or time.time()
+        return [ring.peak(now) for ring in self.channel["messages"]]
+
+    def totals(self, kind, now=None):
+        now = now or time.time()
+        return [ring.sum(now) for ring in self.channel[kind]]
+
+    async def refresh(self, now=None, chunk=5000):
+        """
+        Scarta gli utenti inattivi o in eccesso e ricalcola la classifica
+        delle ultime ROLLUP_HOURS ore. Scorre gli utenti a blocchi di `chunk`,
+        lasciando lavorare l'event loop tra un blocco e l'altro.
+        """
+        now = now or time.time()
+        cutoff = now - ROLLUP_DAYS * 86400
+        window = ROLLUP_HOURS * 3600
+        users = list(self.users.items())
+        candidates = []
+        stale = []
+        for start in range(0, len(users), chunk):
+            for nick, user in users[start:start + chunk]:
+                if user.last_seen < cutoff:
+                    stale.append(nick)
+                elif now - user.last_seen < window:
+                    candidates.append((-user.hours.total, nick))
+            await asyncio.sleep(0)
+        for nick in stale:
+            self.users.pop(nick, None)
+        excess = len(self.users) - ROLLUP_MAX_USERS
+        if excess > 0:
+            for nick, _ in heapq.nsmallest(excess, self.users.items(), key=lambda item: item[1].last_seen):
+                del self.users[nick]
+        # il totale non ancora aggiornato di un utente è un limite superiore di
+        # quello reale: si aggiornano solo i candidati finché possono entrare in classifica
+        candidates = [item for item in candidates if item[1] in self.users]
+        heapq.heapify(candidates)
+        top = []
+        while candidates and (len(top) < ROLLUP_TOP or -candidates[0][0] > top[0][0]):
+            _, nick = heapq.heappop(candidates)
+            count = self.users[nick].hours.sum(now)
+            if count:
+                heapq.heappush(top, (count, nick)) if len(top) < ROLLUP_TOP else heapq.heappushpop(top, (count, nick))
+        self.top = sorted(((count, self.users[key].nick) for count, key in top),
+                          key=lambda item: (-item[0], item[1].lower()))
+
+class TokenBucket:
+    """Token bucket per asyncio: `rate` token (byte, secondi, ...) al secondo, al massimo `capacity`. Con rate 0 non limita."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount):
+        """Secondi da attendere perché siano disponibili `amount` token (0 se ci sono già)."""
+        if not self.rate:
+            return 0.0
+        self.refill()
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    async def consume(self, amount):
+        """Preleva `amount` token (anche a debito) e attende finché il saldo torna positivo."""
+        if not self.rate:
+            return
+        self.refill()
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+class DCCTransfer:
+    """
+    Un trasferimento DCC (invio o ricezione) seguito da DCCManager. L'utente
+    è identificato da rete e nick: lo stesso nick su un'altra rete è un
+    altro utente.
+    """
+    def __init__(self, user, filename, direction, file_path, filesize, offset=0, network=None):
+        self.user      = user
+        self.network   = network
+        self.filename  = filename
+        self.direction = direction  # "invio" o "ricezione"
+        self.file_path = file_path
+        self.filesize  = filesize
+        self.offset    = offset
+        self.port      = None       # porta locale (invio) o remota (ricezione)
+        self.address   = None       # indirizzo del client (solo ricezione)
+        self.resumed   = False      # invio ripreso con DCC RESUME/ACCEPT
+        self.state     = "in coda"
+        self.rate      = 0.0        # byte/s, media sull'ultimo secondo
+        self.ended     = None
+        self.sample    = (time.monotonic(), offset)
+
+    @property
+    def owner(self):
+        return (self.network, self.user)
+
+    @property
+    def key(self):
+        return (self.network, self.user, self.filename, self.port)
+
+    def advance(self, amount):
+        self.offset += amount
+        now = time.monotonic()
+        since, at_offset = self.sample
+        if now - since >= 1.0:
+            self.rate = (self.offset - at_offset) / (now - since)
+            self.sample = (now, self.offset)
+
+    def current_rate(self):
+        """Velocità attuale: zero se il trasferimento è fermo da qualche secondo."""
+        now = time.monotonic()
+        since, at_offset = self.sample
+        if now - since >= 3.0:
+            return 0.0
+        return self.rate or (self.offset - at_offset) / max(now - since, 0.001)
+
+class DCCManager:
+    """
+    Gestore dei trasferimenti DCC:
+    - limita i trasferimenti contemporanei (in totale e per utente) e mette
+      in coda le richieste in eccesso, avviandole appena si libera un posto;
+    - limita la banda con token bucket globale e per utente;
+    - assegna le porte da DCC_PORT_MIN..DCC_PORT_MAX in ordine, saltando
+      quelle già usate da un trasferimento o occupate da altri programmi;
+    - tiene gli invii interrotti per DCC_RESUME_WINDOW secondi, per il resume.
+    """
+    def __init__(self, log):
+        self.log       = log
+        self.active    = set()    # DCCTransfer in corso (in attesa di connessione o attivi)
+        self.resumable = {}       # chiave (utente, file, porta) -> invio interrotto
+        self.queue     = deque()  # (transfer, job, notify) in attesa di un posto
+        self.tasks     = set()
+        self.ports     = set()    # porte riservate
+        self.next_port = DCC_PORT_MIN
+        self.bucket    = TokenBucket(DCC_RATE_TOTAL)
+        self.user_buckets = {}
+
+    def running_for(self, owner):
+        return sum(1 for t in self.active if t.owner == owner)
+
+    def can_start(self, owner):
+        return len(self.active) < DCC_MAX_TRANSFERS and self.running_for(owner) < DCC_MAX_PER_USER
+
+    def submit(self, transfer, job, notify):
+        """
+        Avvia `job(transfer)` (coroutine del trasferimento) se i limiti lo
+        permettono, altrimenti lo mette in coda. `notify(testo)` avvisa l'utente.
+        """
+        if self.can_start(transfer.owner):
+            self.start(transfer, job)
+        elif len(self.queue) >= DCC_MAX_QUEUED:
+            notify("Troppi trasferimenti in corso, riprova più tardi.")
+            if transfer.port is not None:
+                self.ports.discard(transfer.port)
+        else:
+            self.queue.append((transfer, job, notify))
+            notify(f"Trasferimento di {transfer.filename} in coda (posizione {len(self.queue)}).")
+
+    def start(self, transfer, job):
+        transfer.state = "in attesa"
+        self.active.add(transfer)
+        task = asyncio.get_running_loop().create_task(job(transfer))
+        self.tasks.add(task)
+        task.add_done_callback(lambda task: self.finished(transfer, task))
+
+    def finished(self, transfer, task):
+        self.tasks.discard(task)
+        self.active.discard(transfer)
+        transfer.ended = time.monotonic()
+        if transfer.direction == "invio" and transfer.port is not None:
+            if 0 < transfer.offset < transfer.filesize or transfer.state == "interrotto":
+                transfer.state = "interrotto"
+                self.resumable[transfer.key] = transfer
+            else:
+                self.ports.discard(transfer.port)
+        # avvia le richieste in coda che ora rientrano nei limiti
+        for item in list(self.queue):
+            if self.can_start(item[0].owner):
+                self.queue.remove(item)
+                self.start(item[0], item[1])
+
+    def find(self, key):
+        """Invio in attesa di connessione o interrotto con questa chiave (per DCC RESUME)."""
+        for transfer in self.active:
+            if transfer.direction == "invio" and transfer.key == key:
+                return transfer
+        return self.resumable.get(key)
+
+    def resume(self, transfer, offset, job, notify):
+        """Riprende da `offset` un invio interrotto, sulla stessa porta."""
+        del self.resumable[transfer.key]
+        transfer.offset = offset
+        transfer.resumed = True
+        transfer.sample = (time.monotonic(), offset)
+        self.submit(transfer, job, notify)
+
+    def expire(self):
+        now = time.monotonic()
+        for key, transfer in list(self.resumable.items()):
+            if now - transfer.ended > DCC_RESUME_WINDOW:
+                del self.resumable[key]
+                self.ports.discard(transfer.port)
+
+    async def listen(self, transfer):
+        """
+        Apre la porta DCC dell'invio (quella già assegnata in caso di resume,
+        altrimenti la prima libera dopo l'ultima usata). Restituisce il server
+        in ascolto e un future che si completa con (reader, writer) alla prima
+        connessione del client.
+        """
+        accepted = asyncio.get_running_loop().create_future()
+        def on_connect(reader, writer):
+            if accepted.done():
+                writer.close()
+            else:
+                accepted.set_result((reader, writer))
+        if transfer.port is not None:
+            return await asyncio.start_server(on_connect, '', transfer.port), accepted
+        self.expire()
+        count = DCC_PORT_MAX - DCC_PORT_MIN + 1
+        for i in range(count):
+            port = DCC_PORT_MIN + (self.next_port - DCC_PORT_MIN + i) % count
+            if port in self.ports:
+                continue
+            try:
+                server = await asyncio.start_server(on_connect, '', port)
+            except OSError:
+                continue  # porta occupata da un altro programma
+            self.ports.add(port)
+            self.next_port = port + 1
+            transfer.port = port
+            return server, accepted
+        raise OSError("Nessuna porta DCC libera")
+
+    async def account(self, transfer, amount):
+        """Registra i byte trasferiti e attende quanto serve per rispettare i limiti di banda."""
+        transfer.advance(amount)
+        bucket = self.user_buckets.get(transfer.owner)
+        if bucket is None:
+            bucket = self.user_buckets[transfer.owner] = TokenBucket(DCC_RATE_PER_USER)
+        await self.bucket.consume(amount)
+        await bucket.consume(amount)
+
+    def slice_size(self):
+        """Blocchi più piccoli quando la banda è limitata, così il flusso resta regolare."""
+        limits = [rate for rate in (DCC_RATE_TOTAL, DCC_RATE_PER_USER) if rate]
+        if not limits:
+            return DCC_SEND_SLICE
+        return min(DCC_SEND_SLICE, max(64 * 1024, min(limits) // 4))
+
+    def report(self):
+        """Righe di stato per il comando !transfers."""
+        total = sum(t.current_rate() for t in self.active)
+        lines = [f"Trasferimenti: {len(self.active)} attivi, {len(self.queue)} in coda, "
+                 f"{len(self.resumable)} interrotti, totale {total / 1024:.0f} KB/s"]
+        for t in sorted(self.active, key=lambda t: (t.network or "", t.user)):
+            percent = 100 * t.offset // t.filesize if t.filesize else 100
+            lines.append(f"{t.user}@{t.network} {t.direction} {t.filename}: {t.state}, {percent}% "
+                         f"di {t.filesize // 1024} KB, {t.current_rate() / 1024:.0f} KB/s")
+        for position, (t, _, _) in enumerate(self.queue, 1):
+            lines.append(f"{position}. in coda: {t.user}@{t.network} {t.direction} {t.filename}")
+        return lines
+
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+class Channel:
+    """Canale seguito dal bot: scope delle statistiche, statistiche nel tempo e utenti presenti."""
+    def __init__(self, network, name):
+        self.name    = name
+        self.scope   = network + "/" + name
+        self.rollups = Rollups()
+        self.members = set()  # nick (in minuscolo) presenti nel canale
+
+def split_message(line, limit):
+    """
+    Divide un PRIVMSG/NOTICE in righe da al massimo `limit` byte (UTF-8),
+    ripetendo "COMANDO destinatario :" e spezzando preferibilmente a uno
+    spazio, mai dentro un carattere multibyte. Le altre righe e i CTCP
+    restano come sono.
+    """
+    data = line.encode("utf-8")
+    if len(data) <= limit:
+        return [line]
+    head, sep, text = line.partition(" :")
+    if not sep or text.startswith("\x01") or head.split(" ", 1)[0] not in ("PRIVMSG", "NOTICE"):
+        return [line]
+    head = head + sep
+    room = limit - len(head.encode("utf-8"))
+    if room < 32:
+        return [line]
+    text = text.encode("utf-8")
+    lines = []
+    while text:
+        if len(text) <= room:
+            cut = len(text)
+        else:
+            cut = room
+            while text[cut] & 0xC0 == 0x80:  # byte di continuazione UTF-8
+                cut -= 1
+            space = text.rfind(b" ", 0, cut + 1)
+            if space > room // 2:
+                cut = space
+        lines.append(head + text[:cut].decode("utf-8"))
+        text = text[cut:].lstrip(b" ")
+    return lines
+
+class SendQueue:
+    """
+    Coda di invio verso il server IRC, svuotata da un solo task (run):
+    - priorità: prima i PONG, poi i comandi di controllo e i CTCP (offerte
+      DCC), infine i messaggi normali, in ordine di arrivo; il QUIT di
+      IRCBot.quit() va dopo tutto il resto;
+    - ritmo dato dal controllo del flood dei server (RFC 1459, 8.10): ogni
+      riga costa `penalty` secondi più uno ogni `per_bytes` byte, con al
+      massimo `window` secondi di anticipo, gestiti con un TokenBucket;
+    - PRIVMSG e NOTICE più lunghi del limite di 512 byte vengono divisi;
+    - i benvenuti ancora in coda per lo stesso canale diventano uno solo.
+    """
+    def __init__(self, nick, log, raw_log, penalty=None, per_bytes=None, window=None):
+        self.log       = log
+        self.raw_log   = raw_log
+        self.penalty   = IRC_FLOOD_PENALTY if penalty is None else penalty
+        self.per_bytes = per_bytes or IRC_FLOOD_BYTES
+        self.bucket    = TokenBucket(1.0, IRC_FLOOD_WINDOW if window is None else window)
+        self.heap      = []      # (priorità, numero progressivo, riga o benvenuto)
+        self.seq       = 0
+        self.welcomes  = {}      # canale -> lista di nick del benvenuto ancora in coda
+        self.ready     = asyncio.Event()
+        self.empty     = asyncio.Event()
+        self.empty.set()
+        self.dropped   = 0
+        # il server inoltra ":nick!user@host " davanti a ogni riga: finché non
+        # lo conosciamo (dal nostro JOIN) si assume la lunghezza massima
+        self.set_prefix(f"{nick}!{'u' * 10}@{'h' * 63}")
+
+    def set_prefix(self, prefix):
+        self.limit = IRC_MAX_LINE - 2 - len(f":{prefix} ".encode("utf-8"))
+
+    def priority(self, line):
+        command, _, rest = line.partition(" ")
+        if command == "PONG":
+            return 0
+        if command in ("PRIVMSG", "NOTICE") and " :\x01" not in rest:
+            return 2
+        return 1
+
+    def push(self, priority, item):
+        if priority == 2 and len(self.heap) >= IRC_SEND_QUEUE:
+            self.dropped += 1
+            return False
+        self.seq += 1
+        heapq.heappush(self.heap, (priority, self.seq, item))
+        self.empty.clear()
+        self.ready.set()
+        return True
+
+    def put(self, line):
+        priority = self.priority(line)
+        for part in split_message(line, self.limit):
+            self.push(priority, part)
+
+    def welcome(self, channel, nick):
+        """Benvenuto a `nick`, accorpato a quello già in coda per `channel` se c'è spazio."""
+        nicks = self.welcomes.get(channel)
+        if nicks is not None and len(self.render_welcome(channel, nicks + [nick]).encode("utf-8")) <= self.limit:
+            nicks.append(nick)
+            return
+        nicks = [nick]
+        if self.push(2, (channel, nicks)):
+            self.welcomes[channel] = nicks
+
+    def render_welcome(self, channel, nicks):
+        return "PRIVMSG " + channel + " :Benvenuto, " + ", ".join(nicks) + "!"
+
+    def render(self, item):
+        if isinstance(item, tuple):
+            return self.render_welcome(*item)
+        return item
+
+    async def run(self, writer):
+        while True:
+            if not self.heap:
+                self.empty.set()
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            # si attende finché il server accetterebbe la prima riga in coda
+            # senza contarla come flood; se intanto arriva una riga più urgente
+            # (un PONG) si ricomincia da quella
+            data = (self.render(self.heap[0][2]) + "\r\n").encode("utf-8")
+            cost = self.penalty + len(data) / self.per_bytes
+            delay = self.bucket.delay(cost)
+            if delay > 0:
+                self.ready.clear()
+                try:
+                    await asyncio.wait_for(self.ready.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, item = heapq.heappop(self.heap)
+            if isinstance(item, tuple) and self.welcomes.get(item[0]) is item[1]:
+                del self.welcomes[item[0]]  # da qui in poi i benvenuti vanno in una nuova riga
+            item = self.render(item)
+            await self.bucket.consume(cost)
+            if self.dropped:
+                self.log(f"{self.dropped} messaggi scartati (coda di invio piena).")
+                self.dropped = 0
+            self.raw_log(">> " + item)
+            writer.write(data)
+            await writer.drain()
+
+class BotManager:
+    """
+    Un solo processo e un solo event loop per tutte le reti: ogni rete ha la
+    sua connessione (IRCBot), mentre il log, il database delle statistiche e
+    il gestore DCC (porte, code e limiti di banda) sono condivisi.
+    """
+    def __init__(self, networks):
+        self.log        = BotLog(LOG_FILE)
+        self.dcc        = DCCManager(self.log_message)
+        self.stats      = StatsStore(STATS_DB)
+        self.tasks      = set()  # task in corso (salvataggio statistiche, ...)
         self.start_time = time.time()
-        
-        # Statistiche del canale
-        self.stats = {
-            "messages": 0,
-            "joins": 0,
-            "parts": 0,
-            "quits": 0,
-            "users": {}
-        }
-        self.running   = True
-        self.last_save = time.time()
-        self.lock      = threading.Lock()
+        self.running    = True
+        self.last_save  = time.time()
         
         # Creazione cartelle per i file se non esistono
         if not os.path.exists(SHARED_DIR):
@@ -69,148 +1027,324 @@ class IRCBot:
         if not os.path.exists(UPLOAD_DIR):
             os.makedirs(UPLOAD_DIR)
         
-        # Carica statistiche precedenti se esistono
+        # le statistiche salvate prima del supporto a più reti appartengono alla prima
+        self.bots = [IRCBot(self, network, legacy=(i == 0)) for i, network in enumerate(networks)]
+        
+        # Importa le statistiche del vecchio file JSON, se presente
         if os.path.exists(STATS_FILE):
             self.load_stats()
     
     def log_message(self, message):
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        line = f"[{timestamp}] {message}\n"
-        with open(LOG_FILE, "a") as f:
-            f.write(line)
-        print(line.strip())
+        self.log.write(message)
+    
+    def channels(self):
+        for bot in self.bots:
+            yield from bot.channels.values()
     
     def save_stats(self):
-        with self.lock:
-            try:
-                with open(STATS_FILE, "w") as f:
-                    json.dump(self.stats, f, indent=4)
-                self.log_message("Statistiche salvate su file.")
-            except Exception as e:
-                self.log_message(f"Errore nel salvataggio delle statistiche: {e}")
+        try:
+            self.stats.flush()
+        except Exception as e:
+            self.log_message(f"Errore nel salvataggio delle statistiche: {e}")
+    
+    def snapshot_stats(self):
+        try:
+            self.stats.snapshot(STATS_SNAPSHOT)
+            self.log_message("Snapshot delle statistiche salvato.")
+        except Exception as e:
+            self.log_message(f"Errore nello snapshot delle statistiche: {e}")
     
     def load_stats(self):
+        scope = self.bots[0].home.scope
         try:
-            with open(STATS_FILE, "r") as f:
-                self.stats = json.load(f)
-            self.log_message("Statistiche caricate da file.")
+            if self.stats.import_json(STATS_FILE, scope):
+                self.log_message(f"Statistiche importate da {STATS_FILE} in {scope}.")
         except Exception as e:
             self.log_message(f"Errore nel caricamento delle statistiche: {e}")
     
-    def connect(self):
+    def spawn(self, coro):
+        """Avvia un task tenendone un riferimento fino alla fine."""
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+    
+    async def save_periodically(self):
+        """Scrive i delta delle statistiche (e ogni tanto uno snapshot) fuori dal thread di rete."""
+        last_snapshot = time.time()
+        while self.running:
+            await asyncio.sleep(SAVE_INTERVAL)
+            await asyncio.to_thread(self.save_stats)
+            self.last_save = time.time()
+            if self.last_save - last_snapshot >= SNAPSHOT_INTERVAL:
+                await asyncio.to_thread(self.snapshot_stats)
+                last_snapshot = self.last_save
+    
+    async def refresh_rollups(self):
+        while self.running:
+            await asyncio.sleep(ROLLUP_REFRESH)
+            for channel in list(self.channels()):
+                await channel.rollups.refresh()
+    
+    async def run_bot(self, bot):
+        """Una rete che non risponde o cade non ferma le altre."""
+        try:
+            await bot.connect()
+            await bot.run()
+        except OSError as e:
+            bot.log_message(f"Errore di connessione: {e}")
+    
+    async def run(self):
+        self.spawn(self.save_periodically())
+        self.spawn(self.refresh_rollups())
+        try:
+            await asyncio.gather(*(self.run_bot(bot) for bot in self.bots))
+        finally:
+            self.running = False
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.dcc.close()
+            self.save_stats()
+            self.stats.close()
+    
+    async def shutdown(self, reason):
+        self.running = False
+        await asyncio.gather(*(bot.quit(reason) for bot in self.bots), return_exceptions=True)
+
+class IRCBot:
+    """
+    Connessione del bot a una rete IRC, con uno o più canali. Gira come
+    coroutine nell'event loop di BotManager, insieme alle altre reti e ai
+    trasferimenti DCC.
+    """
+    def __init__(self, manager, network, legacy=False):
+        self.manager   = manager
+        self.name      = network["name"]
+        self.server    = network["server"]
+        self.port      = network.get("port", PORT)
+        self.botnick   = network["nick"]
+        self.password  = network.get("password", BOT_PASSWORD)
+        self.admins    = set(network.get("admins", ()))      # comandi avanzati e OP, solo su questa rete
+        self.file_users = set(network.get("file_users", ()))  # upload/download DCC, solo su questa rete
+        self.reader    = None
+        self.writer    = None
+        self.log       = manager.log
+        self.dcc       = manager.dcc    # porte e limiti di banda condivisi tra le reti
+        self.stats     = manager.stats
+        self.running   = True
+        self.sendq     = SendQueue(self.botnick, self.log_message, lambda line: self.log.raw(f"[{self.name}] " + line),
+                                   network.get("flood_penalty"), network.get("flood_bytes"), network.get("flood_window"))
+        self.sender    = None   # task che svuota sendq sulla connessione
+        self.accepts   = {}     # (nick, porta) -> future del DCC ACCEPT atteso per un upload
+        
+        # Canali della rete (chiave in minuscolo); il primo riceve i comandi in privato
+        self.channels  = {}
+        for name in network["channels"]:
+            channel = Channel(self.name, name)
+            self.stats.open_scope(channel.scope, legacy=name if legacy else None)
+            self.channels[name.lower()] = channel
+        self.home      = self.channels[network["channels"][0].lower()]
+        
+        # Comando IRC -> lista di coroutine handler(msg); vedi register_handler
+        self.handlers  = {
+            "PING":    [self.on_ping],
+            "JOIN":    [self.on_join],
+            "PART":    [self.on_part],
+            "KICK":    [self.on_kick],
+            "QUIT":    [self.on_quit],
+            "NICK":    [self.on_nick],
+            "353":     [self.on_names],
+            "PRIVMSG": [self.on_privmsg],
+        }
+    
+    def log_message(self, message):
+        self.log.write(f"[{self.name}] {message}")
+    
+    async def connect(self):
         self.log_message(f"Connessione a {self.server}:{self.port}...")
-        self.ircsock.connect((self.server, self.port))
+        self.reader, self.writer = await asyncio.open_connection(self.server, self.port, limit=IRC_LINE_LIMIT)
+        self.sender = asyncio.get_running_loop().create_task(self.send_loop())
         self.send_cmd("NICK " + self.botnick)
         self.send_cmd("USER {0} {0} {0} :Python IRC Bot Esteso".format(self.botnick))
-        time.sleep(2)
+        await asyncio.sleep(2)
         # Autenticazione NickServ (se la password è impostata)
-        if BOT_PASSWORD:
-            self.send_cmd("PRIVMSG NickServ :IDENTIFY " + BOT_PASSWORD)
+        if self.password:
+            self.send_cmd("PRIVMSG NickServ :IDENTIFY " + self.password)
             self.log_message("Autenticazione NickServ inviata.")
-        time.sleep(1)
-        self.send_cmd("JOIN " + self.channel)
+        await asyncio.sleep(1)
+        for channel in self.channels.values():
+            self.send_cmd("JOIN " + channel.name)
     
     def send_cmd(self, command):
-        self.log_message(">> " + command)
-        self.ircsock.send((command + "\r\n").encode("utf-8"))
+        """Accoda il comando: lo invia send_loop, al ritmo consentito dal server."""
+        self.sendq.put(command)
     
-    def run(self):
-        buffer = ""
-        while self.running:
+    async def send_loop(self):
+        try:
+            await self.sendq.run(self.writer)
+        except OSError as e:
+            self.log_message("Errore nell'invio: " + str(e))
+            self.writer.close()
+    
+    async def read_line(self):
+        """Legge una riga dal server (senza \\r\\n); None a connessione chiusa."""
+        overrun = False
+        while True:
             try:
-                data = self.ircsock.recv(2048).decode("utf-8", errors="ignore")
-            except Exception as e:
-                self.log_message("Errore nella ricezione: " + str(e))
-                break
-            if not data:
-                self.log_message("Connessione chiusa dal server.")
-                break
-            buffer += data
-            while "\r\n" in buffer:
-                line, buffer = buffer.split("\r\n", 1)
-                self.log_message("<< " + line)
-                self.handle_line(line)
-            if time.time() - self.last_save > SAVE_INTERVAL:
-                self.save_stats()
-                self.last_save = time.time()
-        self.save_stats()
-    
-    def handle_line(self, line):
-        # Gestione PING
-        if line.startswith("PING"):
-            self.send_cmd("PONG " + line.split()[1])
+                data = await self.reader.readuntil(b"\n")
+            except asyncio.IncompleteReadError:
+                return None
+            except asyncio.LimitOverrunError as e:
+                # riga oltre IRC_LINE_LIMIT: la scartiamo fino al prossimo \n
+                await self.reader.readexactly(e.consumed)
+                overrun = True
+                continue
+            if overrun:
+                self.log_message("Riga troppo lunga scartata.")
+                overrun = False
+                continue
+            return data.rstrip(b"\r\n").decode("utf-8", errors="ignore")
+    
+    async def run(self):
+        try:
+            while self.running:
+                try:
+                    line = await self.read_line()
+                except OSError as e:
+                    self.log_message("Errore nella ricezione: " + str(e))
+                    break
+                if line is None:
+                    if self.running:
+                        self.log_message("Connessione chiusa dal server.")
+                    break
+                if not line:
+                    continue
+                self.log.raw(f"[{self.name}] << " + line)
+                await self.handle_line(line)
+        finally:
+            self.sender.cancel()
+            self.writer.close()
+    
+    async def quit(self, reason):
+        """
+        Invia QUIT dopo quanto è già in coda (attendendo al massimo
+        IRC_QUIT_TIMEOUT secondi) e chiude la connessione: run() termina subito dopo.
+        """
+        self.running = False
+        if self.writer is None or self.writer.is_closing():
             return
-        
-        parts = line.split(" ")
-        if len(parts) < 2:
+        self.sendq.push(3, "QUIT :" + reason)
+        try:
+            await asyncio.wait_for(self.sendq.empty.wait(), IRC_QUIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.log_message("Coda di invio non svuotata in tempo, chiusura forzata.")
+        self.writer.close()
+    
+    def register_handler(self, command, handler):
+        """
+        Registra una coroutine handler(msg) per un comando IRC (es. "PRIVMSG",
+        "KICK", "001"). Più handler per lo stesso comando vengono chiamati
+        nell'ordine di registrazione.
+        """
+        self.handlers.setdefault(command.upper(), []).append(handler)
+    
+    async def handle_line(self, line):
+        msg = parse_message(line)
+        if msg is None:
             return
-        
-        cmd = parts[1]
-        
-        # Gestione dei messaggi CTCP (per DCC)
-        if "PRIVMSG" in parts and "\x01" in line:
-            m = re.match(r":([^!]+)!", parts[0])
-            if not m:
-                return
-            nick = m.group(1)
-            target = parts[2]
-            msg = " ".join(parts[3:])[1:]
-            if msg.startswith("DCC"):
-                self.handle_ctcp(nick, target, msg)
-                return
-        
-        # Gestione degli eventi JOIN, PART e QUIT
-        if cmd == "JOIN":
-            m = re.match(r":([^!]+)!", parts[0])
-            if m:
-                nick = m.group(1)
-                with self.lock:
-                    self.stats["joins"] += 1
-                self.send_cmd("PRIVMSG " + self.channel + " :Benvenuto, " + nick + "!")
-                # Se l'utente è un admin, assegnagli OP
-                if nick in ADMINS:
-                    self.send_cmd("MODE " + self.channel + " +o " + nick)
+        for handler in self.handlers.get(msg.command, ()):
+            await handler(msg)
+    
+    def channel_for(self, msg):
+        """Canale seguito a cui si riferisce il messaggio (primo parametro), o None."""
+        return self.channels.get(msg.params[0].lower()) if msg.params else None
+    
+    async def on_ping(self, msg):
+        self.send_cmd("PONG :" + (msg.params[0] if msg.params else self.server))
+    
+    async def on_join(self, msg):
+        nick, channel = msg.nick, self.channel_for(msg)
+        if nick is None or channel is None:
             return
-        
-        elif cmd == "PART":
-            m = re.match(r":([^!]+)!", parts[0])
-            if m:
-                nick = m.group(1)
-                with self.lock:
-                    self.stats["parts"] += 1
-                self.log_message(f"{nick} ha lasciato il canale.")
+        if nick == self.botnick:
+            channel.members.clear()  # l'elenco arriva subito dopo con RPL_NAMREPLY
+            self.sendq.set_prefix(msg.prefix)
             return
-        
-        elif cmd == "QUIT":
-            m = re.match(r":([^!]+)!", parts[0])
-            if m:
-                nick = m.group(1)
-                with self.lock:
-                    self.stats["quits"] += 1
-                self.log_message(f"{nick} ha disconnesso dal server.")
+        channel.members.add(nick.lower())
+        self.stats.incr(channel.scope, "joins")
+        channel.rollups.record("joins", nick)
+        # su un rientro dopo un netsplit i benvenuti in coda diventano uno solo
+        self.sendq.welcome(channel.name, nick)
+        # Se l'utente è un admin, assegnagli OP
+        if nick in self.admins:
+            self.send_cmd("MODE " + channel.name + " +o " + nick)
+    
+    async def on_part(self, msg):
+        nick, channel = msg.nick, self.channel_for(msg)
+        if nick is None or channel is None:
             return
+        channel.members.discard(nick.lower())
+        self.stats.incr(channel.scope, "parts")
+        channel.rollups.record("parts", nick)
+        self.log_message(f"{nick} ha lasciato {channel.name}.")
+    
+    async def on_kick(self, msg):
+        channel = self.channel_for(msg)
+        if channel is not None and len(msg.params) >= 2:
+            channel.members.discard(msg.params[1].lower())
+    
+    async def on_quit(self, msg):
+        nick = msg.nick
+        if nick is None:
+            return
+        # il QUIT vale per tutti i canali della rete in cui l'utente era presente
+        key = nick.lower()
+        for channel in self.channels.values():
+            if key in channel.members:
+                channel.members.discard(key)
+                self.stats.incr(channel.scope, "quits")
+                channel.rollups.record("quits", nick)
+        self.log_message(f"{nick} ha disconnesso dal server.")
+    
+    async def on_nick(self, msg):
+        if msg.nick is None or not msg.params:
+            return
+        old, new = msg.nick.lower(), msg.params[0].lower()
+        for channel in self.channels.values():
+            if old in channel.members:
+                channel.members.discard(old)
+                channel.members.add(new)
+    
+    async def on_names(self, msg):
+        # RPL_NAMREPLY: <nick> <tipo> <canale> :<nick con eventuale prefisso @, +, ...>
+        if len(msg.params) < 4:
+            return
+        channel = self.channels.get(msg.params[2].lower())
+        if channel is not None:
+            channel.members.update(name.lstrip("~&@%+").lower() for name in msg.params[3].split())
+    
+    async def on_privmsg(self, msg):
+        nick = msg.nick
+        if nick is None or len(msg.params) < 2:
+            return
+        target, text = msg.params[0], msg.params[1]
         
-        # Gestione dei messaggi PRIVMSG non CTCP
-        if cmd == "PRIVMSG":
-            m = re.match(r":([^!]+)!", parts[0])
-            if not m:
-                return
-            nick = m.group(1)
-            target = parts[2]
-            msg = " ".join(parts[3:])[1:]
-            
-            with self.lock:
-                self.stats["messages"] += 1
-                if nick not in self.stats["users"]:
-                    self.stats["users"][nick] = 0
-                self.stats["users"][nick] += 1
-            
-            # Se il messaggio inizia con "!" lo consideriamo un comando
-            if msg.startswith("!"):
-                self.handle_command(nick, msg)
+        # Gestione dei messaggi CTCP (per DCC)
+        if text.startswith("\x01") and text.lstrip("\x01").startswith("DCC"):
+            await self.handle_ctcp(nick, target, text)
             return
+        
+        # i messaggi privati valgono per il primo canale della rete
+        channel = self.channels.get(target.lower(), self.home)
+        self.stats.message(channel.scope, nick)
+        channel.rollups.record("messages", nick)
+        
+        # Se il messaggio inizia con "!" lo consideriamo un comando
+        if text.startswith("!"):
+            await self.handle_command(nick, text, channel)
     
-    def handle_ctcp(self, sender, target, msg):
+    async def handle_ctcp(self, sender, target, msg):
         """Gestisce i messaggi CTCP DCC: SEND (upload), RESUME e ACCEPT per il resume."""
         tokens = msg.strip("\x01").split()
         if len(tokens) < 2:
@@ -218,117 +1352,160 @@ class IRCBot:
         subcmd = tokens[1].upper()
         if subcmd == "SEND":
             if target == self.botnick:
-                if sender not in FILE_ALLOWED_USERS:
+                if sender not in self.file_users:
                     self.send_cmd("PRIVMSG " + sender + " :Non sei autorizzato ad inviare file.")
                     return
                 self.dcc_receive(sender, msg)
         elif subcmd == "RESUME":
             self.handle_dcc_resume(sender, msg)
+        elif subcmd == "ACCEPT":
+            self.handle_dcc_accept(sender, msg)
     
-    def handle_command(self, nick, msg):
-        """Gestisce i comandi testuali inviati in chat."""
+    async def handle_command(self, nick, msg, channel):
+        """Gestisce i comandi testuali inviati in chat; le risposte vanno nel canale `channel`."""
         cmd_parts = msg.strip().split(" ")
         command = cmd_parts[0][1:].lower()  # rimuove il carattere '!'
         # Comandi avanzati per admin
-        if command in ["stats", "uptime", "kick", "shutdown"]:
-            if nick not in ADMINS:
+        if command in ["stats", "uptime", "kick", "shutdown", "transfers"]:
+            if nick not in self.admins:
                 self.send_cmd("PRIVMSG " + nick + " :Non sei autorizzato ad usare questo comando.")
                 return
-            self.handle_admin_command(nick, msg)
+            await self.handle_admin_command(nick, msg, channel)
             return
         # Comandi di file sharing e help
         if command == "help":
-            help_msg = ("Comandi disponibili: !help, !files, !get <filename>, !stats, !uptime, !kick <nick>, !shutdown")
-            self.send_cmd("PRIVMSG " + self.channel + " :" + help_msg)
+            help_msg = ("Comandi disponibili: !help, !files, !get <filename>, !top, !activity <nick>, !peak, "
+                        "!stats, !uptime, !kick <nick>, !transfers, !shutdown")
+            self.send_cmd("PRIVMSG " + channel.name + " :" + help_msg)
         elif command == "files":
             files = os.listdir(SHARED_DIR)
             files_list = [f for f in files if os.path.isfile(os.path.join(SHARED_DIR, f))]
             response = "Files disponibili: " + ", ".join(files_list) if files_list else "Nessun file disponibile."
-            self.send_cmd("PRIVMSG " + self.channel + " :" + response)
+            self.send_cmd("PRIVMSG " + channel.name + " :" + response)
+        elif command == "top":
+            if channel.rollups.top:
+                ranking = ", ".join(f"{n}. {nick} ({count})" for n, (count, nick) in enumerate(channel.rollups.top, 1))
+                self.send_cmd("PRIVMSG " + channel.name + f" :Più attivi nelle ultime {ROLLUP_HOURS} ore: " + ranking)
+            else:
+                self.send_cmd("PRIVMSG " + channel.name + " :Classifica non ancora disponibile.")
+        elif command == "activity":
+            if len(cmd_parts) < 2:
+                self.send_cmd("PRIVMSG " + channel.name + " :Utilizzo: !activity <nick>")
+                return
+            target = cmd_parts[1]
+            activity = channel.rollups.activity(target)
+            if activity is None:
+                self.send_cmd("PRIVMSG " + channel.name + " :Nessuna attività registrata per " + target + ".")
+            else:
+                hour, hours, days, joins, parts, quits = activity
+                self.send_cmd("PRIVMSG " + channel.name + f" :{target}: {hour} messaggi in quest'ora, "
+                              f"{hours} nelle ultime {ROLLUP_HOURS} ore, {days} negli ultimi {ROLLUP_DAYS} giorni; "
+                              f"{joins} join, {parts} part, {quits} quit negli ultimi {ROLLUP_DAYS} giorni.")
+        elif command == "peak":
+            (minute, minute_at), (hour, hour_at), (day, day_at) = channel.rollups.peaks()
+            if not day:
+                self.send_cmd("PRIVMSG " + channel.name + " :Nessun messaggio registrato.")
+                return
+            fmt = lambda ts, pattern: time.strftime(pattern, time.localtime(ts))
+            self.send_cmd("PRIVMSG " + channel.name + f" :Picchi di messaggi: {minute}/min alle {fmt(minute_at, '%H:%M')}, "
+                          f"{hour}/h alle {fmt(hour_at, '%H:00')} del {fmt(hour_at, '%d/%m')}, "
+                          f"{day} il {fmt(day_at, '%d/%m')} (ultimi {ROLLUP_DAYS} giorni).")
         elif command == "get":
             if len(cmd_parts) >= 2:
                 filename = cmd_parts[1]
-                if nick not in FILE_ALLOWED_USERS:
+                if nick not in self.file_users:
                     self.send_cmd("PRIVMSG " + nick + " :Non sei autorizzato a scaricare file.")
                     return
-                threading.Thread(target=self.dcc_send, args=(filename, nick)).start()
+                self.dcc_send(filename, nick)
             else:
-                self.send_cmd("PRIVMSG " + self.channel + " :Utilizzo: !get <filename>")
+                self.send_cmd("PRIVMSG " + channel.name + " :Utilizzo: !get <filename>")
         else:
-            self.send_cmd("PRIVMSG " + self.channel + " :Comando non riconosciuto.")
+            self.send_cmd("PRIVMSG " + channel.name + " :Comando non riconosciuto.")
     
-    def handle_admin_command(self, nick, msg):
+    async def handle_admin_command(self, nick, msg, channel):
         """Gestisce i comandi avanzati inviati dagli admin."""
         cmd_parts = msg.strip().split(" ")
         command = cmd_parts[0][1:].lower()
         if command == "stats":
-            with self.lock:
-                response = (f"Stats: Messaggi: {self.stats['messages']}, Joins: {self.stats['joins']}, "
-                            f"Parts: {self.stats['parts']}, Quits: {self.stats['quits']}, "
-                            f"Utenti: {len(self.stats['users'])}.")
-            self.send_cmd("PRIVMSG " + self.channel + " :" + response)
+            # il numero di utenti si conta nel database, dopo aver scritto i delta in sospeso
+            await asyncio.to_thread(self.manager.save_stats)
+            users = await asyncio.to_thread(self.stats.user_count, channel.scope)
+            totals = self.stats.totals[channel.scope]
+            response = (f"Stats: Messaggi: {totals['messages']}, Joins: {totals['joins']}, "
+                        f"Parts: {totals['parts']}, Quits: {totals['quits']}, "
+                        f"Utenti: {users}.")
+            self.send_cmd("PRIVMSG " + channel.name + " :" + response)
         elif command == "uptime":
-            elapsed = int(time.time() - self.start_time)
+            elapsed = int(time.time() - self.manager.start_time)
             hours, rem = divmod(elapsed, 3600)
             minutes, seconds = divmod(rem, 60)
             uptime_str = f"{hours}h {minutes}m {seconds}s"
-            self.send_cmd("PRIVMSG " + self.channel + " :Uptime: " + uptime_str)
+            self.send_cmd("PRIVMSG " + channel.name + " :Uptime: " + uptime_str)
         elif command == "kick":
             if len(cmd_parts) >= 2:
                 target = cmd_parts[1]
-                self.send_cmd("KICK " + self.channel + " " + target + " :Kicked by admin")
+                self.send_cmd("KICK " + channel.name + " " + target + " :Kicked by admin")
             else:
-                self.send_cmd("PRIVMSG " + self.channel + " :Utilizzo: !kick <nick>")
+                self.send_cmd("PRIVMSG " + channel.name + " :Utilizzo: !kick <nick>")
+        elif command == "transfers":
+            for line in self.dcc.report():
+                self.send_cmd("PRIVMSG " + nick + " :" + line)
         elif command == "shutdown":
-            self.send_cmd("PRIVMSG " + self.channel + " :Shutting down as requested by admin.")
-            self.running = False
-            self.ircsock.close()
-            sys.exit(0)
+            self.send_cmd("PRIVMSG " + channel.name + " :Shutting down as requested by admin.")
+            # chiude le connessioni a tutte le reti: BotManager.run() termina
+            await self.manager.shutdown("Shutdown")
+    
+    def notifier(self, nick):
+        return lambda text: self.send_cmd("PRIVMSG " + nick + " :" + text)
+    
+    async def dcc_accept(self, server, accepted):
+        """Attende la connessione del client (al massimo DCC_TIMEOUT secondi) e chiude la porta."""
+        try:
+            return await asyncio.wait_for(accepted, DCC_TIMEOUT)
+        finally:
+            server.close()
     
     def dcc_send(self, filename, user):
-        """Invia un file tramite DCC SEND (con supporto a resume)."""
-        file_path = os.path.join(SHARED_DIR, filename)
-        if not os.path.exists(file_path):
+        """Invia un file tramite DCC SEND (con supporto a resume), passando dal gestore DCC."""
+        file_path = os.path.join(SHARED_DIR, os.path.basename(filename))
+        if not os.path.isfile(file_path):
             self.send_cmd("PRIVMSG " + user + " :File non trovato.")
             return
-        filesize = os.path.getsize(file_path)
-        port = choose_dcc_port()
-        my_ip = socket.gethostbyname(socket.gethostname())
-        ip_int = struct.unpack("!I", socket.inet_aton(my_ip))[0]
-        dcc_msg = f"\x01DCC SEND {filename} {ip_int} {port} {filesize}\x01"
-        self.send_cmd("PRIVMSG " + user + " :" + dcc_msg)
-        self.log_message(f"Richiesta DCC SEND per file {filename} a {user} sulla porta {port}")
-        key = (user, filename, port)
-        ACTIVE_DCC_TRANSFERS[key] = {"file_path": file_path, "filesize": filesize, "offset": 0}
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        transfer = DCCTransfer(user, filename, "invio", file_path, os.path.getsize(file_path), network=self.name)
+        self.dcc.submit(transfer, self.dcc_send_transfer, self.notifier(user))
+    
+    async def dcc_send_transfer(self, transfer):
+        user, filename = transfer.user, transfer.filename
         try:
-            s.bind(('', port))
-            s.listen(1)
-            s.settimeout(60)
-            conn, addr = s.accept()
-            self.log_message(f"Connessione DCC da {addr} per invio file {filename}")
-            current_offset = 0
-            with open(file_path, "rb") as f:
-                while current_offset < filesize:
-                    chunk = f.read(1024)
-                    if not chunk:
-                        break
-                    try:
-                        conn.sendall(chunk)
-                    except Exception as e:
-                        self.log_message(f"Trasferimento interrotto a {current_offset} byte: {e}")
-                        ACTIVE_DCC_TRANSFERS[key]["offset"] = current_offset
-                        return
-                    current_offset += len(chunk)
-                    ACTIVE_DCC_TRANSFERS[key]["offset"] = current_offset
-            self.log_message(f"File {filename} inviato a {user}")
-            conn.close()
-            if key in ACTIVE_DCC_TRANSFERS:
-                del ACTIVE_DCC_TRANSFERS[key]
+            # la porta deve essere già in ascolto quando il client riceve l'offerta
+            server, accepted = await self.dcc.listen(transfer)
+            port = transfer.port
+            if transfer.resumed:
+                self.send_cmd("PRIVMSG " + user + " :" + f"\x01DCC ACCEPT {filename} {port} {transfer.offset}\x01")
+                self.log_message(f"Inviato DCC ACCEPT per {filename} a {user} per resume da offset {transfer.offset}")
+            else:
+                my_ip = socket.gethostbyname(socket.gethostname())
+                ip_int = struct.unpack("!I", socket.inet_aton(my_ip))[0]
+                dcc_msg = f"\x01DCC SEND {filename} {ip_int} {port} {transfer.filesize}\x01"
+                self.send_cmd("PRIVMSG " + user + " :" + dcc_msg)
+                self.log_message(f"Richiesta DCC SEND per file {filename} a {user} sulla porta {port}")
+            reader, conn = await self.dcc_accept(server, accepted)
+            self.log_message(f"Connessione DCC da {conn.get_extra_info('peername')} per invio file {filename}")
+            # l'offset si legge solo ora: un DCC RESUME può arrivare mentre si attende la connessione
+            transfer.state = "attivo"
+            transfer.sample = (time.monotonic(), transfer.offset)
+            try:
+                await dcc_stream_file(conn, transfer.file_path, transfer.offset, transfer.filesize,
+                                      lambda sent: self.dcc.account(transfer, sent), self.dcc.slice_size())
+                self.log_message(f"File {filename} inviato a {user}")
+                transfer.state = "completato"
+            except (OSError, RuntimeError) as e:  # RuntimeError: connessione chiusa dal client durante sendfile
+                self.log_message(f"Trasferimento interrotto a {transfer.offset} byte: {e}")
+                transfer.state = "interrotto"
+            finally:
+                conn.close()
         except Exception as e:
-            self.log_message(f"Errore durante DCC SEND: {e}")
-        finally:
-            s.close()
+            self.log_message(f"Errore durante DCC SEND: {e!r}")
     
     def handle_dcc_resume(self, sender, msg):
         """
@@ -337,7 +1514,7 @@ class IRCBot:
            "\x01DCC RESUME <filename> <port> <offset>\x01"
         """
         tokens = msg.strip("\x01").split()
-        if len(tokens) < 4:
+        if len(tokens) < 5:
             self.log_message("Formato DCC RESUME non valido.")
             return
         try:
@@ -347,97 +1524,350 @@ class IRCBot:
         except Exception as e:
             self.log_message(f"Errore nel parsing di DCC RESUME: {e}")
             return
-        key = (sender, filename, port)
-        if key not in ACTIVE_DCC_TRANSFERS:
+        transfer = self.dcc.find((self.name, sender, filename, port))
+        if transfer is None:
             self.log_message("Nessun trasferimento attivo per questo file (resume request).")
             return
-        record = ACTIVE_DCC_TRANSFERS[key]
-        if offset >= record["filesize"]:
+        if offset >= transfer.filesize:
             self.log_message("Offset invalido per il file.")
             return
-        accept_msg = f"\x01DCC ACCEPT {filename} {port} {offset}\x01"
-        self.send_cmd("PRIVMSG " + sender + " :" + accept_msg)
-        self.log_message(f"Inviato DCC ACCEPT per {filename} a {sender} per resume da offset {offset}")
-        threading.Thread(target=self.dcc_send_resume, args=(sender, record["file_path"], filename, port, record["filesize"], offset, key)).start()
+        if transfer.state == "in attesa":
+            # offerta appena fatta: il client ha già una parte del file
+            transfer.offset = offset
+            self.send_cmd("PRIVMSG " + sender + " :" + f"\x01DCC ACCEPT {filename} {port} {offset}\x01")
+            self.log_message(f"Inviato DCC ACCEPT per {filename} a {sender} per resume da offset {offset}")
+        elif transfer.state == "interrotto":
+            self.dcc.resume(transfer, offset, self.dcc_send_transfer, self.notifier(sender))
     
-    def dcc_send_resume(self, user, file_path, filename, port, filesize, offset, key):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def handle_dcc_accept(self, sender, msg):
+        """
+        Risposta del client al nostro DCC RESUME per un upload:
+           "\x01DCC ACCEPT <filename> <port> <offset>\x01"
+        (alcuni client mettono "file.ext" al posto del nome: si usa la porta).
+        """
+        tokens = msg.strip("\x01").split()
         try:
-            s.bind(('', port))
-            s.listen(1)
-            s.settimeout(60)
-            self.log_message(f"In attesa di connessione DCC per resume del file {filename} sulla porta {port}")
-            conn, addr = s.accept()
-            self.log_message(f"Connessione DCC per resume da {addr} per file {filename}")
-            with open(file_path, "rb") as f:
-                f.seek(offset)
-                current_offset = offset
-                while current_offset < filesize:
-                    chunk = f.read(1024)
-                    if not chunk:
-                        break
-                    try:
-                        conn.sendall(chunk)
-                    except Exception as e:
-                        self.log_message(f"Trasferimento resume interrotto a {current_offset} byte: {e}")
-                        ACTIVE_DCC_TRANSFERS[key]["offset"] = current_offset
-                        return
-                    current_offset += len(chunk)
-            self.log_message(f"File {filename} inviato (resume completato) a {user}")
-            conn.close()
-            if key in ACTIVE_DCC_TRANSFERS:
-                del ACTIVE_DCC_TRANSFERS[key]
-        except Exception as e:
-            self.log_message(f"Errore durante DCC SEND (resume): {e}")
+            port = int(tokens[3])
+            offset = int(tokens[4])
+        except (IndexError, ValueError):
+            self.log_message("Formato DCC ACCEPT non valido.")
+            return
+        accepted = self.accepts.get((sender, port))
+        if accepted is None or accepted.done():
+            self.log_message(f"DCC ACCEPT inatteso da {sender} per la porta {port}.")
+            return
+        accepted.set_result(offset)
+    
+    async def dcc_resume_offset(self, transfer, part_size):
+        """
+        Chiede al client di riprendere l'upload da `part_size` (DCC RESUME) e
+        restituisce l'offset concordato, oppure 0 se il client non risponde
+        con DCC ACCEPT entro DCC_ACCEPT_TIMEOUT secondi: in quel caso invierà
+        il file dall'inizio.
+        """
+        sender, port = transfer.user, transfer.address[1]
+        accepted = asyncio.get_running_loop().create_future()
+        self.accepts[(sender, port)] = accepted
+        try:
+            self.send_cmd("PRIVMSG " + sender + " :" + f"\x01DCC RESUME {transfer.filename} {port} {part_size}\x01")
+            offset = await asyncio.wait_for(accepted, DCC_ACCEPT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.log_message(f"Nessun DCC ACCEPT da {sender} per {transfer.filename}: upload da capo.")
+            return 0
         finally:
-            s.close()
+            del self.accepts[(sender, port)]
+        if not 0 <= offset <= part_size:
+            raise ValueError(f"offset {offset} nel DCC ACCEPT non compatibile con il .part ({part_size} byte)")
+        return offset
     
     def dcc_receive(self, sender, msg):
         """
         Gestisce il trasferimento in upload tramite DCC SEND.
         Il formato atteso è:
            "\x01DCC SEND <filename> <ip_int> <port> <filesize>\x01"
-        Se il trasferimento viene interrotto, il client potrà tentare un resume.
+        Il file arriva in "<filename>.part" e viene rinominato solo a
+        trasferimento completo. Se un .part di un upload interrotto esiste
+        già, prima di connettersi si concorda il resume con DCC RESUME/ACCEPT.
         """
+        tokens = msg.strip("\x01").split()
         try:
-            tokens = msg.strip("\x01").split()
-            if len(tokens) < 5:
-                self.log_message("Formato DCC SEND non valido per upload.")
-                return
-            filename = tokens[2]
+            filename = os.path.basename(tokens[2])
             ip_int = int(tokens[3])
             port = int(tokens[4])
             filesize = int(tokens[5])
-            ip = socket.inet_ntoa(struct.pack("!I", ip_int))
-            self.log_message(f"Ricevuto DCC SEND da {sender} per file {filename} ({filesize} bytes) da {ip}:{port}")
-            dest_path = os.path.join(UPLOAD_DIR, filename)
-            resume_offset = os.path.getsize(dest_path) if os.path.exists(dest_path) else 0
+        except (IndexError, ValueError):
+            self.log_message("Formato DCC SEND non valido per upload.")
+            return
+        ip = socket.inet_ntoa(struct.pack("!I", ip_int & 0xFFFFFFFF))
+        self.log_message(f"Ricevuto DCC SEND da {sender} per file {filename} ({filesize} bytes) da {ip}:{port}")
+        transfer = DCCTransfer(sender, filename, "ricezione", os.path.join(UPLOAD_DIR, filename), filesize,
+                               network=self.name)
+        transfer.address = (ip, port)
+        self.dcc.submit(transfer, self.dcc_receive_transfer, self.notifier(sender))
+    
+    async def dcc_receive_transfer(self, transfer):
+        sender, filename, dest_path = transfer.user, transfer.filename, transfer.file_path
+        try:
+            part_path = dest_path + ".part"
+            # un .part grande quanto il file è rimasto preallocato da un crash: si riparte da zero
+            part_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            resume_offset = 0
+            if 0 < part_size < transfer.filesize:
+                transfer.state = "resume"
+                resume_offset = await self.dcc_resume_offset(transfer, part_size)
+            if os.path.exists(part_path):
+                # i byte oltre l'offset concordato non valgono più
+                os.truncate(part_path, resume_offset)
+            transfer.offset = resume_offset
+            loop = asyncio.get_running_loop()
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(60)
-            s.connect((ip, port))
-            mode = "ab" if resume_offset > 0 else "wb"
-            with open(dest_path, mode) as f:
-                total_received = resume_offset
-                while total_received < filesize:
-                    chunk = s.recv(1024)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-                    total_received += len(chunk)
+            s.setblocking(False)
+            try:
+                await asyncio.wait_for(loop.sock_connect(s, transfer.address), DCC_TIMEOUT)
+                transfer.state = "attivo"
+                transfer.sample = (time.monotonic(), resume_offset)
+                total_received = await dcc_receive_file(s, part_path, resume_offset, transfer.filesize,
+                                                        lambda n: self.dcc.account(transfer, n))
+            finally:
+                s.close()
+            if total_received < transfer.filesize:
+                self.log_message(f"Upload di {filename} da {sender} interrotto a {total_received} byte.")
+                return
+            os.replace(part_path, dest_path)
+            transfer.state = "completato"
             self.log_message(f"File {filename} ricevuto da {sender} e salvato in {dest_path}")
-            s.close()
             self.send_cmd("PRIVMSG " + sender + " :Upload di " + filename + " completato.")
         except Exception as e:
-            self.log_message(f"Errore durante DCC RECEIVE (upload): {e}")
+            self.log_message(f"Errore durante DCC RECEIVE (upload): {e!r}")
+
+def bench_dcc(sizes_mb):
+    """
+    Benchmark su loopback dei trasferimenti DCC.
+    Invio: blocchi da 1024 byte con write/drain (il vecchio metodo) contro
+    dcc_stream_file (sendfile); il client gira in un thread e legge con
+    recv_into in un buffer da 1 MiB. I file di prova sono sparsi, quindi si
+    misura la rete e non il disco.
+    Ricezione: read(1024) + write contro dcc_receive_file, con un mittente
+    in un thread che usa socket.sendfile; qui il file viene scritto su disco.
+    Uso: irc_bot.py --bench-dcc [MB ...]
+    """
+    import tempfile
+
+    async def chunked(conn, file_path, offset, filesize):
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            while offset < filesize:
+                chunk = f.read(1024)
+                if not chunk:
+                    break
+                conn.write(chunk)
+                await conn.drain()
+                offset += len(chunk)
+
+    def client(port, filesize, result):
+        s = socket.create_connection(("127.0.0.1", port))
+        buf = bytearray(1024 * 1024)
+        received = 0
+        while received < filesize:
+            n = s.recv_into(buf)
+            if not n:
+                break
+            received += n
+        s.close()
+        result.append(received)
+
+    async def run(sender, file_path, filesize):
+        accepted = asyncio.get_running_loop().create_future()
+        server = await asyncio.start_server(lambda r, w: accepted.set_result(w), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        result = []
+        thread = threading.Thread(target=client, args=(port, filesize, result))
+        started = time.perf_counter()
+        thread.start()
+        conn = await accepted
+        server.close()
+        await sender(conn, file_path, 0, filesize)
+        await conn.drain()
+        await asyncio.to_thread(thread.join)
+        elapsed = time.perf_counter() - started
+        conn.close()
+        return elapsed, result[0] == filesize
+
+    async def chunked_receive(sock, part_path, offset, filesize):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        with open(part_path, "wb") as f:
+            while offset < filesize:
+                chunk = await reader.read(1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+                offset += len(chunk)
+        return offset
+
+    def upload_sender(listener, file_path):
+        conn, _ = listener.accept()
+        # gli ACK vanno letti, altrimenti riempiono il buffer del mittente
+        drain = threading.Thread(target=lambda: [None for _ in iter(lambda: conn.recv(65536), b"")])
+        drain.start()
+        with open(file_path, "rb") as f:
+            conn.sendfile(f)
+        conn.shutdown(socket.SHUT_WR)
+        drain.join()
+        conn.close()
+
+    async def run_receive(receiver, file_path, filesize, part_path):
+        listener = socket.create_server(("127.0.0.1", 0))
+        thread = threading.Thread(target=upload_sender, args=(listener, file_path))
+        thread.start()
+        loop = asyncio.get_running_loop()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(False)
+        started = time.perf_counter()
+        await loop.sock_connect(s, listener.getsockname())
+        received = await receiver(s, part_path, 0, filesize)
+        elapsed = time.perf_counter() - started
+        s.close()
+        await asyncio.to_thread(thread.join)
+        listener.close()
+        os.remove(part_path)
+        return elapsed, received == filesize
+
+    print("Invio (prima riga) e ricezione (seconda riga) per ogni dimensione")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_mb in sizes_mb:
+            file_path = os.path.join(tmp, f"{size_mb}MB.bin")
+            filesize = int(size_mb * 1024 * 1024)
+            with open(file_path, "wb") as f:
+                f.truncate(filesize)
+            row = [f"{size_mb:>6g} MB"]
+            for name, sender in (("1024 byte", chunked), ("sendfile", dcc_stream_file)):
+                elapsed, ok = asyncio.run(run(sender, file_path, filesize))
+                row.append(f"{name}: {filesize / 1024 / 1024 / elapsed:8.1f} MB/s{'' if ok else ' (INCOMPLETO)'}")
+            print("  ".join(row))
+            row = [f"{'':>6} ->"]
+            part_path = os.path.join(tmp, "upload.part")
+            for name, receiver in (("1024 byte", chunked_receive), ("recv_into", dcc_receive_file)):
+                elapsed, ok = asyncio.run(run_receive(receiver, file_path, filesize, part_path))
+                row.append(f"{name}: {filesize / 1024 / 1024 / elapsed:8.1f} MB/s{'' if ok else ' (INCOMPLETO)'}")
+            print("  ".join(row))
+            os.remove(file_path)
+
+def bench_parse(log_path=None, count=200000):
+    """
+    Micro-benchmark del parsing delle righe IRC, in righe al secondo.
+    Confronta la vecchia handle_line (split(" "), ricerca di "PRIVMSG" nella
+    lista, regex ricompilata in ogni ramo, catena di if/elif) con
+    parse_message + ricerca dell'handler nel dizionario; in entrambi i casi
+    si estraggono nick, destinatario e testo, senza eseguire i comandi.
+    Accetta un log IRC grezzo o un irc_bot.log (si usano solo le righe "<< ").
+    Senza file genera `count` righe con la distribuzione tipica di un canale.
+    Uso: irc_bot.py --bench-parse [file]
+    """
+    if log_path:
+        lines = []
+        with open(log_path, encoding="utf-8", errors="ignore") as f:
+            for raw in f:
+                raw = raw.rstrip("\r\n")
+                pos = raw.find("<< ")
+                if pos >= 0:
+                    raw = raw[pos + 3:]
+                elif ">> " in raw:
+                    continue  # comandi inviati dal bot
+                if raw:
+                    lines.append(raw)
+    else:
+        # distribuzione tipica di un canale: soprattutto PRIVMSG, qualche
+        # JOIN/PART/QUIT, PING e numerici del server ogni tanto
+        privmsg = ":nick{0}!~user@host{0}.example.org PRIVMSG #canale :"
+        samples = [privmsg + text for text in (
+            "ciao", "ciao a tutti, come va oggi?", "!stats", "qualcuno ha visto la partita ieri sera?",
+            "sì", "ahahah", "!uptime", "non saprei, bisogna provare",
+            "un messaggio un po' più lungo degli altri, " * 3, "ok", "grazie mille :)", "a dopo",
+        )] * 3 + [
+            ":nick{0}!~user@host{0}.example.org JOIN #canale",
+            ":nick{0}!~user@host{0}.example.org PART #canale :ciao",
+            ":nick{0}!~user@host{0}.example.org QUIT :Ping timeout: 240 seconds",
+            ":nick{0}!~user@host{0}.example.org PRIVMSG bot :\x01DCC SEND file.bin 2130706433 50000 1024\x01",
+            ":nick{0}!~user@host{0}.example.org NOTICE #canale :avviso",
+            ":irc.example.org 353 bot = #canale :nick1 nick2 nick3 nick4 nick5",
+            "PING :irc.example.org",
+        ]
+        lines = [samples[i % len(samples)].format(i % 997) for i in range(count)]
+
+    def legacy(line):
+        if line.startswith("PING"):
+            return line.split()[1]
+        parts = line.split(" ")
+        if len(parts) < 2:
+            return None
+        cmd = parts[1]
+        if "PRIVMSG" in parts and "\x01" in line:
+            m = re.match(r":([^!]+)!", parts[0])
+            if not m:
+                return None
+            msg = " ".join(parts[3:])[1:]
+            if msg.lstrip("\x01").startswith("DCC"):
+                return (m.group(1), parts[2], msg)
+        if cmd == "JOIN":
+            m = re.match(r":([^!]+)!", parts[0])
+            return m and m.group(1)
+        elif cmd == "PART":
+            m = re.match(r":([^!]+)!", parts[0])
+            return m and m.group(1)
+        elif cmd == "QUIT":
+            m = re.match(r":([^!]+)!", parts[0])
+            return m and m.group(1)
+        if cmd == "PRIVMSG":
+            m = re.match(r":([^!]+)!", parts[0])
+            if not m:
+                return None
+            return (m.group(1), parts[2], " ".join(parts[3:])[1:])
+        return None
+
+    handlers = {"PING": True, "JOIN": True, "PART": True, "QUIT": True, "PRIVMSG": True}
+
+    def current(line):
+        # nick e parametri sono già estratti: gli handler li leggono da msg
+        msg = parse_message(line)
+        if msg is not None and msg.command in handlers:
+            return msg.nick, msg.params
+        return None
+
+    # le due versioni si alternano e si tiene il tempo migliore di ciascuna,
+    # così il rumore della macchina pesa allo stesso modo su entrambe
+    variants = (("split + regex", legacy), ("parse_message", current))
+    best = {}
+    for _ in range(5):
+        for name, func in variants:
+            started = time.perf_counter()
+            for line in lines:
+                func(line)
+            elapsed = time.perf_counter() - started
+            best[name] = min(elapsed, best.get(name, elapsed))
+    print(f"{len(lines)} righe")
+    for name, _ in variants:
+        print(f"{name:>14}: {len(lines) / best[name]:12,.0f} righe/s")
+
+async def main():
+    manager = BotManager(NETWORKS)
+    try:
+        await manager.run()
+    finally:
+        manager.log.close()
 
 if __name__ == "__main__":
-    bot = IRCBot(SERVER, PORT, CHANNEL, BOTNICK)
+    if "--bench-dcc" in sys.argv:
+        sizes = [float(a) for a in sys.argv[sys.argv.index("--bench-dcc") + 1:]]
+        bench_dcc(sizes or [10, 100, 1024, 2048])
+        sys.exit(0)
+    if "--bench-parse" in sys.argv:
+        args = sys.argv[sys.argv.index("--bench-parse") + 1:]
+        bench_parse(args[0] if args else None)
+        sys.exit(0)
     try:
-        bot.connect()
-        bot.run()
+        asyncio.run(main())
     except KeyboardInterrupt:
-        bot.log_message("Chiusura del bot per KeyboardInterrupt.")
-        bot.running = False
-        bot.save_stats()
+        # run() salva le statistiche uscendo (anche quando viene cancellato)
+        print("Chiusura del bot per KeyboardInterrupt.")
         sys.exit(0)
 
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+telegram_client.py
+
+Client condiviso per la Bot API di Telegram, usato da fbquery_bot.py,
+hugo2tg.py e uboat_today_to_hugo.py.
+
+- una sola requests.Session con pool di connessioni keep-alive (niente
+  nuova connessione TCP+TLS per ogni sendMessage/getUpdates);
+- long polling di getUpdates con ripresa automatica dopo errori di rete;
+- limitazione della frequenza di invio con token bucket (globale e per chat)
+  e rispetto del retry_after restituito da Telegram con l'errore 429;
+- nuovi tentativi con backoff esponenziale su errori di rete e 5xx.
+
+Gli invii restano sincroni nel thread chiamante: fbquery_bot.py accorpa già i
+risultati in messaggi da MESSAGE_CHUNK caratteri, e un unico thread di invio
+farebbe attendere tutte le chat dietro il limite di 1 messaggio/s di una sola.
+"""
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+API_URL = "https://api.telegram.org/bot{token}/{method}"
+
+REQUEST_TIMEOUT = 15   # secondi, oltre al timeout del long polling
+MAX_RETRIES     = 5
+BACKOFF_BASE    = 1.0  # secondi, raddoppia a ogni tentativo
+BACKOFF_MAX     = 30.0
+POOL_SIZE       = 8    # connessioni keep-alive verso api.telegram.org
+
+# Limiti di Telegram: ~30 messaggi/s in totale, ~1 messaggio/s per chat
+GLOBAL_RATE  = 30.0
+GLOBAL_BURST = 30
+CHAT_RATE    = 1.0
+CHAT_BURST   = 3
+
+# Metodi che inviano messaggi e quindi consumano i token del rate limiter
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "forwardMessage", "copyMessage"}
+
+
+class TelegramError(Exception):
+    """Errore restituito dalla Bot API (ok = false) o tentativi esauriti."""
+    def __init__(self, description, error_code=None):
+        super().__init__(description)
+        self.error_code = error_code
+
+
+class TokenBucket:
+    """Token bucket thread-safe: `rate` token al secondo, al massimo `capacity`."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Prenota un token e restituisce quanti secondi attendere prima di usarlo."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Svuota il bucket per `seconds` secondi (dopo un 429)."""
+        with self.lock:
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class TelegramClient:
+    """
+    Client thread-safe per la Bot API. I metodi bloccano il thread chiamante
+    (i bot sono sincroni e usano già thread propri), ma condividono il pool di
+    connessioni e i limiti di frequenza.
+    """
+    def __init__(self, token, timeout=REQUEST_TIMEOUT):
+        self.token = token
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.buckets_lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        with self.buckets_lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+            return bucket
+
+    def call(self, method, data=None, timeout=None, retries=MAX_RETRIES):
+        """
+        Chiama un metodo della Bot API e restituisce il campo "result".
+        Ripete la richiesta su errori di rete, 5xx e 429 (rispettando retry_after).
+        """
+        url = API_URL.format(token=self.token, method=method)
+        chat_bucket = None
+        if method in SEND_METHODS and data and "chat_id" in data:
+            chat_bucket = self._chat_bucket(data["chat_id"])
+        attempt = 0
+        while True:
+            if method in SEND_METHODS:
+                self.global_bucket.acquire()
+                if chat_bucket is not None:
+                    chat_bucket.acquire()
+            try:
+                response = self.session.post(url, data=data, timeout=timeout or self.timeout)
+                payload = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                error, retry_after = TelegramError(f"{method}: {e}"), None
+            else:
+                if payload.get("ok"):
+                    return payload.get("result")
+                code = payload.get("error_code", response.status_code)
+                error = TelegramError(f"{method}: {payload.get('description', response.text)}", code)
+                retry_after = payload.get("parameters", {}).get("retry_after")
+                if code != 429 and code < 500:
+                    raise error
+            attempt += 1
+            if attempt > retries:
+                raise error
+            if retry_after and method in SEND_METHODS:
+                # Telegram ci chiede di fermarci: svuotiamo il bucket, così
+                # aspettano anche gli altri invii verso la stessa chat
+                (chat_bucket or self.global_bucket).pause(retry_after)
+                print(f"Errore Telegram ({error}), nuovo tentativo tra {retry_after}s", flush=True)
+                continue
+            delay = retry_after or min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+            print(f"Errore Telegram ({error}), nuovo tentativo tra {delay:.0f}s", flush=True)
+            time.sleep(delay)
+
+    def send_message(self, chat_id, text, parse_mode=None, **extra):
+        data = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        data.update(extra)
+        return self.call("sendMessage", data)
+
+    def get_updates(self, offset=None, timeout=30):
+        """Una chiamata di long polling: attende fino a `timeout` secondi nuovi update."""
+        data = {"timeout": timeout}
+        if offset:
+            data["offset"] = offset
+        return self.call("getUpdates", data, timeout=timeout + self.timeout, retries=0)
+
+    def iter_updates(self, timeout=30):
+        """
+        Long polling continuo: restituisce gli update appena arrivano e
+        ripete subito la richiesta. Dopo un errore attende con backoff
+        crescente invece di terminare.
+        """
+        offset = None
+        failures = 0
+        while True:
+            try:
+                updates = self.get_updates(offset, timeout)
+                failures = 0
+            except TelegramError as e:
+                failures += 1
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1))
+                print(f"Errore nel polling: {e} (nuovo tentativo tra {delay:.0f}s)", flush=True)
+                time.sleep(delay)
+                continue
+            for update in updates:
+                offset = update["update_id"] + 1
+                yield update
+
+    def close(self):
+        self.session.close()
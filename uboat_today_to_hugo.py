@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, re, subprocess, sys
-from datetime import datetime
+import os, re, sys, json, time, hashlib, sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from typing import List
+from html.parser import HTMLParser
 import requests
 from bs4 import BeautifulSoup
+from telegram_client import TelegramClient, TokenBucket
+import hugo_build
 
 # --- Config base (adatta se serve) ---
 BLOG_PATH   = "/home/pi/blog"
@@ -13,6 +17,18 @@ POSTS_DIR   = os.path.join(BLOG_PATH, "content/posts")
 BASE_URL    = "https://timrouter.dns.army/blog/posts"  # coerente con index.html
 POST_SLUG   = "uboat-events"
 REQUEST_TIMEOUT = 15
+TODAY_URL   = "https://uboat.net/today.html"
+# Pagina "on this day" per una data qualsiasi (usata dal backfill)
+DAY_URL     = "https://uboat.net/today.html?day={day}&month={month}"
+BACKFILL_WORKERS = 4    # richieste contemporanee verso uboat.net
+BACKFILL_RATE    = 1.0  # richieste al secondo, per non sovraccaricare il sito
+
+# Tag: sempre presenti + gazetteer di luoghi e navi (formato nel file stesso)
+BASE_TAGS      = {"uboat", "eventi", "seconda-guerra-mondiale", "storia", "marina"}
+GAZETTEER_FILE = os.getenv("UBOAT_GAZETTEER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "uboat_gazetteer.txt"))
+
+# Cache HTTP su disco (ETag/Last-Modified) e impronte dei blocchi già pubblicati
+CACHE_DIR   = os.getenv("UBOAT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "uboat-events"))
 
 # Telegram come nel tuo rss_daily_digest.py
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
@@ -24,6 +40,9 @@ TELEGRAM_CHAT_ID   = os.getenv("TELEGRAM_CHAT_ID", "")
 TRANSLATE = True
 LIBRETRANSLATE_URL = os.getenv("LIBRETRANSLATE_URL", "")
 DEEPL_API_KEY = os.getenv("DEEPL_API_KEY", "")
+# Memoria di traduzione (SQLite) e caratteri massimi per richiesta al traduttore
+TM_DB_PATH = os.path.join(CACHE_DIR, "translations.sqlite")
+TM_BATCH_CHARS = 4000
 
 def now_rome():
     try:
@@ -32,31 +51,284 @@ def now_rome():
     except Exception:
         return datetime.now()
 
-def fetch_today_html():
-    url = "https://uboat.net/today.html"
-    r = requests.get(url, timeout=REQUEST_TIMEOUT, headers={"User-Agent":"uboat-events/1.0"})
-    r.raise_for_status()
-    return r.text
+def cache_path(url: str, dt_local: datetime, ext: str) -> str:
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"{dt_local.strftime('%Y-%m-%d')}-{key}.{ext}")
 
-def extract_general_events(html: str, today_dt: datetime) -> List[str]:
+def fetch_today_html(dt_local: datetime = None, url: str = TODAY_URL, replay: bool = False) -> str:
     """
-    Ritorna lista di paragrafi/righe Markdown-ready della sezione 'General Events on <Day Month>'.
+    Scarica la pagina usando la cache su disco (chiave: URL + data).
+    Se la pagina del giorno è già in cache invia If-None-Match/If-Modified-Since
+    e, con risposta 304, riusa la copia locale. Con replay=True non usa la rete.
     """
-    soup = BeautifulSoup(html, "html.parser")
+    dt_local = dt_local or now_rome()
+    html_path = cache_path(url, dt_local, "html")
+    meta_path = cache_path(url, dt_local, "json")
+    cached = None
+    meta = {}
+    if os.path.exists(html_path):
+        with open(html_path, encoding="utf-8") as f:
+            cached = f.read()
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+    if replay:
+        if cached is None:
+            raise FileNotFoundError(f"Nessuna pagina in cache per {dt_local.strftime('%Y-%m-%d')}: {html_path}")
+        return cached
+
+    headers = {"User-Agent": "uboat-events/1.0"}
+    if cached is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    r = requests.get(url, timeout=REQUEST_TIMEOUT, headers=headers)
+    if r.status_code == 304 and cached is not None:
+        print("[INFO] Pagina non modificata (304), uso la copia in cache.")
+        return cached
+    r.raise_for_status()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(html_path, "w", encoding="utf-8") as f:
+        f.write(r.text)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({"url": url, "etag": r.headers.get("ETag"),
+                   "last_modified": r.headers.get("Last-Modified"),
+                   "fetched": datetime.now().isoformat(timespec="seconds")}, f)
+    return r.text
 
+def events_digest(lines_en: List[str]) -> str:
+    return hashlib.sha256("\n".join(lines_en).encode("utf-8")).hexdigest()
+
+def already_published(dt_local: datetime, digest: str) -> bool:
+    """Vero se per questa data è già stato pubblicato esattamente questo blocco di eventi."""
+    path = cache_path(TODAY_URL, dt_local, "sha256")
+    if not os.path.exists(path):
+        return False
+    with open(path, encoding="utf-8") as f:
+        stored, _, post_path = f.read().strip().partition(" ")
+    return stored == digest and os.path.exists(post_path)
+
+def mark_published(dt_local: datetime, digest: str, post_path: str):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_path(TODAY_URL, dt_local, "sha256"), "w", encoding="utf-8") as f:
+        f.write(f"{digest} {post_path}\n")
+
+def general_events_title(today_dt: datetime) -> str:
     # Esempio visibile oggi: '## General Events on 21 October'
-    day_label = today_dt.strftime("%-d %B") if sys.platform != "win32" else today_dt.strftime("%#d %B")
     # la pagina usa mese in inglese; assicuriamoci in inglese:
     day_label_en = today_dt.strftime("%-d %B").replace("à", "a") if sys.platform != "win32" else today_dt.strftime("%#d %B")
+    return f"General Events on {day_label_en}"
 
-    target_h2_text = f"General Events on {day_label_en}"
+def _clean_lines(collected: List[str]) -> List[str]:
+    # ripulisci righe vuote multiple
+    out = []
+    for line in collected:
+        line = re.sub(r"\s+", " ", line).strip()
+        if not out or line or out[-1] != "":
+            out.append(line)
+    return out
+
+class _StopParsing(Exception):
+    pass
+
+class GeneralEventsParser(HTMLParser):
+    """
+    Estrattore in streaming della sezione 'General Events on <Day Month>'.
+    Applica le stesse regole di extract_general_events_soup (fratelli dell'h2
+    fino al prossimo h2 o ad "Add more events!") senza costruire l'albero,
+    e smette di leggere la pagina appena la sezione cercata è finita.
+    Come il tree builder html.parser di BeautifulSoup, un tag di chiusura
+    chiude anche i tag rimasti aperti al suo interno e quelli senza apertura
+    vengono ignorati.
+    Con `strict` accetta solo l'h2 esatto, senza ripiegare su un altro
+    'General Events on ...' della pagina.
+    """
+    VOID = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+            "meta", "param", "source", "track", "wbr"}
+
+    def __init__(self, target_h2_text: str, strict: bool = False):
+        super().__init__(convert_charrefs=True)
+        self.target = target_h2_text
+        self.strict = strict
+        self.stack = []          # tag aperti
+        self.h2 = None           # (profondità, testi) dell'h2 in lettura
+        self.section = None      # profondità dei fratelli dell'h2 trovato
+        self.exact = False
+        self.pending = []        # testo libero tra un fratello e l'altro
+        self.sib = None          # (tag, testi, [testi di ogni li diretto])
+        self.li = None           # testi del li diretto aperto
+        self.collected = []
+        self.result = None
+        self.fallback = None
+        self.data = []           # testo letto dall'ultimo tag (feed a blocchi lo spezza)
+
+    # --- gestione della sezione ---
+    def _flush_text(self):
+        txt = "".join(self.pending).strip()
+        self.pending = []
+        if txt:
+            self.collected.append(txt)
+
+    def _end_section(self):
+        self._flush_text()
+        if self.exact:
+            self.result = self.collected
+            raise _StopParsing()
+        if self.fallback is None:
+            self.fallback = self.collected
+        self.section, self.sib, self.li, self.collected = None, None, None, []
+
+    def _close_sibling(self):
+        tag, parts, lis = self.sib
+        self.sib = None
+        if "".join(p.strip() for p in parts).startswith("Add more events!"):
+            self._end_section()
+            return
+        if tag in ("h3", "h4"):
+            self.collected.append("### " + "".join(p.strip() for p in parts))
+        elif tag in ("p", "li", "div"):
+            t = " ".join(p.strip() for p in parts if p.strip())
+            if t:
+                self.collected.append(t)
+        elif tag == "ul":
+            for li in lis:
+                t = " ".join(p.strip() for p in li if p.strip())
+                if t:
+                    self.collected.append(f"- {t}")
+
+    def _close_h2(self):
+        depth, parts = self.h2
+        self.h2 = None
+        text = "".join(p.strip() for p in parts)
+        if text == self.target:
+            self.exact = True
+        elif self.strict or not (self.fallback is None and " ".join(p.strip() for p in parts if p.strip())
+                  .startswith("General Events on ")):
+            return
+        self.section = depth
+        self.collected = []
+
+    def _flush_data(self):
+        if not self.data:
+            return
+        data = "".join(self.data)
+        self.data = []
+        if self.stack and self.stack[-1] in ("script", "style"):
+            return
+        if self.h2 is not None:
+            self.h2[1].append(data)
+        if self.section is not None:
+            if len(self.stack) == self.section:
+                self.pending.append(data)
+            elif self.sib is not None:
+                self.sib[1].append(data)
+                if self.li is not None:
+                    self.li.append(data)
+
+    # --- callback di HTMLParser ---
+    def handle_starttag(self, tag, attrs):
+        self._flush_data()
+        depth = len(self.stack)
+        if self.section is not None:
+            if depth == self.section:
+                self._flush_text()
+                if tag == "h2":
+                    self._end_section()
+                elif tag not in self.VOID:
+                    self.sib = (tag, [], [])
+            elif self.sib is not None and depth == self.section + 1 and tag == "li" and self.sib[0] == "ul":
+                self.li = []
+                self.sib[2].append(self.li)
+        if tag == "h2" and self.h2 is None and self.section is None:
+            self.h2 = (depth, [])
+        if tag not in self.VOID:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._flush_data()
+        if self.section is not None and len(self.stack) == self.section:
+            self._flush_text()
+        if tag not in self.VOID:
+            # <div/> e simili: aperto e chiuso subito
+            self.handle_starttag(tag, attrs)
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self._flush_data()
+        if tag not in self.stack:
+            return
+        while self.stack:
+            closed = self.stack.pop()
+            depth = len(self.stack)
+            if self.h2 is not None and depth == self.h2[0]:
+                self._close_h2()
+            elif self.section is not None:
+                if depth == self.section + 1 and self.li is not None and closed == "li":
+                    self.li = None
+                elif depth == self.section and self.sib is not None:
+                    self._close_sibling()
+                elif depth < self.section:
+                    # si chiude il contenitore dell'h2: la sezione è finita
+                    self._end_section()
+            if closed == tag:
+                break
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_comment(self, data):
+        self._flush_data()
+        if self.section is not None and len(self.stack) == self.section:
+            # BeautifulSoup tratta anche i commenti tra i fratelli come testo
+            self._flush_text()
+            self.pending.append(data)
+            self._flush_text()
+
+    def parse(self, html: str, chunk_size: int = 65536) -> List[str]:
+        try:
+            for i in range(0, len(html), chunk_size):
+                self.feed(html[i:i + chunk_size])
+            self.close()
+            self._flush_data()
+            # a fine pagina si chiudono i tag rimasti aperti, come fa BeautifulSoup
+            while self.stack:
+                self.handle_endtag(self.stack[-1])
+            if self.section is not None:
+                self._end_section()
+        except _StopParsing:
+            pass
+        if self.result is not None:
+            return self.result
+        return self.fallback or []
+
+def extract_general_events(html: str, today_dt: datetime, strict: bool = False) -> List[str]:
+    """
+    Ritorna lista di paragrafi/righe Markdown-ready della sezione 'General Events on <Day Month>'.
+    Usa l'estrattore in streaming; se fallisce ripiega su BeautifulSoup.
+    Con `strict` restituisce [] se manca la sezione esatta di `today_dt`.
+    """
+    try:
+        return _clean_lines(GeneralEventsParser(general_events_title(today_dt), strict).parse(html))
+    except Exception as e:
+        print(f"[WARN] Estrattore in streaming fallito ({e}), uso BeautifulSoup.")
+        return extract_general_events_soup(html, today_dt, strict)
+
+def extract_general_events_soup(html: str, today_dt: datetime, strict: bool = False) -> List[str]:
+    """
+    Ritorna lista di paragrafi/righe Markdown-ready della sezione 'General Events on <Day Month>'.
+    Versione con albero BeautifulSoup completo, usata come riserva dall'estrattore in streaming.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+
+    target_h2_text = general_events_title(today_dt)
     # trova header h2 esatto
     h2 = None
     for tag in soup.find_all(["h2"]):
         if tag.get_text(strip=True) == target_h2_text:
             h2 = tag
             break
-    if not h2:
+    if not h2 and not strict:
         # fallback: cerca "General Events on " e contiene mese corrente
         for tag in soup.find_all(["h2"]):
             t = tag.get_text(" ", strip=True)
@@ -91,35 +363,238 @@ def extract_general_events(html: str, today_dt: datetime) -> List[str]:
                 t = li.get_text(" ", strip=True)
                 if t:
                     collected.append(f"- {t}")
-    # ripulisci righe vuote multiple
+    return _clean_lines(collected)
+
+# --- Memoria di traduzione ---
+# Gli eventi "on this day" si ripetono ogni anno con le stesse frasi: le
+# traduzioni vengono salvate in SQLite (chiave: frase normalizzata + backend)
+# e al traduttore si inviano solo le frasi nuove, raggruppate in poche richieste.
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(])")
+_MD_PREFIX_RE = re.compile(r"^(#+ |- )")
+# Parole col punto che non chiudono la frase (gradi, titoli, mesi, luoghi)
+_ABBREVIATIONS = {
+    "mr", "mrs", "ms", "dr", "st", "mt", "ft", "no", "nos", "vs", "ca", "approx", "cf", "fig",
+    "capt", "cdr", "lt", "ltcdr", "adm", "gen", "col", "maj", "sgt", "cpl", "jr", "sr",
+    "kptlt", "oblt", "kkpt", "fkpt", "kptzs", "korvkpt", "fregkpt", "ltzs", "lzs", "ozs", "obltzs",
+    "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec",
+}
+
+def _is_abbreviation(word: str) -> bool:
+    """Vero se `word` (senza il punto finale) è un'abbreviazione o un'iniziale."""
+    word = word.lstrip("(\"'")
+    # iniziali ("J."), sigle puntate ("U.S.", "Oblt.z.S.")
+    return len(word) == 1 or "." in word or word.lower() in _ABBREVIATIONS
+
+def split_sentences(text: str) -> List[str]:
+    """
+    Divide un paragrafo in frasi dopo . ! ? seguiti da maiuscola, cifra o
+    virgolette, ma non dopo abbreviazioni come "Mr." o "St. Nazaire".
+    """
+    sentences = []
+    start = 0
+    for m in _SENTENCE_RE.finditer(text):
+        head = text[start:m.start()]
+        words = head.split()
+        if words and words[-1].endswith(".") and _is_abbreviation(words[-1][:-1]):
+            continue
+        sentences.append(head)
+        start = m.end()
+    sentences.append(text[start:])
+    return [s for s in sentences if s.strip()]
+
+def normalize_sentence(s: str) -> str:
+    return re.sub(r"\s+", " ", s).strip()
+
+def open_translation_memory(path: str = None):
+    path = path or TM_DB_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute("""CREATE TABLE IF NOT EXISTS tm (
+                      backend TEXT NOT NULL,
+                      source  TEXT NOT NULL,
+                      target  TEXT NOT NULL,
+                      hits    INTEGER NOT NULL DEFAULT 0,
+                      PRIMARY KEY (backend, source))""")
+    return db
+
+def _translation_backend():
+    """Restituisce (nome backend, traduttore) oppure (None, None) se non configurato."""
+    from deep_translator import LibreTranslator, DeeplTranslator
+    if DEEPL_API_KEY:
+        return "deepl", DeeplTranslator(api_key=DEEPL_API_KEY, source="en", target="it")
+    if LIBRETRANSLATE_URL:
+        return f"libre:{LIBRETRANSLATE_URL}", LibreTranslator(source="en", target="it", base_url=LIBRETRANSLATE_URL)
+    return None, None
+
+def _translate_batched(translator, sentences: List[str]) -> List[str]:
+    """
+    Traduce le frasi unendole con "\n" in richieste da al più TM_BATCH_CHARS
+    caratteri. Se il traduttore non restituisce lo stesso numero di righe,
+    il gruppo viene ritradotto frase per frase.
+    """
     out = []
-    for line in collected:
-        line = re.sub(r"\s+", " ", line).strip()
-        if not out or line or out[-1] != "":
-            out.append(line)
+    batch = []
+    size = 0
+    def flush():
+        if not batch:
+            return
+        translated = translator.translate("\n".join(batch)).split("\n")
+        if len(translated) != len(batch):
+            translated = [translator.translate(s) for s in batch]
+        out.extend(normalize_sentence(s) for s in translated)
+    for s in sentences:
+        if batch and size + len(s) + 1 > TM_BATCH_CHARS:
+            flush()
+            batch, size = [], 0
+        batch.append(s)
+        size += len(s) + 1
+    flush()
     return out
 
-def try_translate_to_it(text: str) -> str:
-    if not TRANSLATE or not text.strip():
-        return text
+def try_translate_to_it(text: str, db=None) -> str:
+    return translate_blocks_to_it([text], db)[0]
+
+def translate_blocks_to_it(texts: List[str], db=None) -> List[str]:
+    """
+    Traduce più blocchi insieme: le frasi di tutti i blocchi passano per la
+    memoria di traduzione e quelle nuove partono in un'unica serie di richieste.
+    """
+    if not TRANSLATE or not any(text.strip() for text in texts):
+        return list(texts)
     try:
-        from deep_translator import LibreTranslator, DeeplTranslator
-        if DEEPL_API_KEY:
-            return DeeplTranslator(api_key=DEEPL_API_KEY, source="en", target="it").translate(text)
-        if LIBRETRANSLATE_URL:
-            return LibreTranslator(source="en", target="it", base_url=LIBRETRANSLATE_URL).translate(text)
+        backend, translator = _translation_backend()
+        if translator is None:
+            return list(texts)  # fallback: nessuna traduzione se non configurata
+        own_db = db is None
+        db = db or open_translation_memory()
+        try:
+            # per ogni blocco: paragrafi -> (prefisso markdown, frasi)
+            blocks = []
+            for text in texts:
+                paragraphs = []
+                for par in text.split("\n\n"):
+                    m = _MD_PREFIX_RE.match(par)
+                    prefix = m.group(1) if m else ""
+                    body = par[len(prefix):]
+                    paragraphs.append((prefix, [normalize_sentence(s) for s in split_sentences(body)]))
+                blocks.append(paragraphs)
+            unique = list(dict.fromkeys(s for paragraphs in blocks for _, sents in paragraphs for s in sents))
+            known = {}
+            for i in range(0, len(unique), 500):
+                chunk = unique[i:i + 500]
+                rows = db.execute(f"SELECT source, target FROM tm WHERE backend = ? AND source IN "
+                                  f"({','.join('?' * len(chunk))})", [backend] + chunk).fetchall()
+                known.update(rows)
+            missing = [s for s in unique if s not in known]
+            missing_set = set(missing)  # per i controlli di appartenenza, `missing` tiene l'ordine
+            if missing:
+                translated = _translate_batched(translator, missing)
+                known.update(zip(missing, translated))
+                db.executemany("INSERT OR REPLACE INTO tm (backend, source, target) VALUES (?, ?, ?)",
+                               [(backend, s, known[s]) for s in missing])
+            db.executemany("UPDATE tm SET hits = hits + 1 WHERE backend = ? AND source = ?",
+                           [(backend, s) for s in unique if s not in missing_set])
+            db.commit()
+            hits = len(unique) - len(missing)
+            if unique:
+                print(f"[INFO] Traduzione: {len(unique)} frasi, {hits} dalla memoria "
+                      f"({100 * hits / len(unique):.0f}%), {len(missing)} inviate a {backend}")
+            return ["\n\n".join(prefix + " ".join(known[s] for s in sents) for prefix, sents in paragraphs)
+                    for paragraphs in blocks]
+        finally:
+            if own_db:
+                db.close()
     except Exception:
         pass
-    return text  # fallback: nessuna traduzione se non configurata
+    return list(texts)  # fallback: testo originale se la traduzione fallisce
+
+def load_gazetteer(path: str = GAZETTEER_FILE) -> dict:
+    """
+    Legge il gazetteer (righe "tag = Nome | Variante | ...") e restituisce
+    {nome: tag}. Se il file non esiste restituisce un dizionario vuoto.
+    """
+    names = {}
+    if not os.path.exists(path):
+        return names
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            tag, sep, variants = line.partition("=")
+            if not sep or not tag.strip():
+                print(f"[WARN] {path}:{n}: riga ignorata (manca 'tag = nome')")
+                continue
+            for name in variants.split("|"):
+                name = " ".join(name.split())
+                if name:
+                    names[name] = tag.strip()
+    return names
+
+def _trie_pattern(names) -> str:
+    """
+    Regex equivalente a un trie dei nomi: i prefissi comuni sono fattorizzati,
+    così il confronto con migliaia di nomi costa quanto percorrere il trie.
+    """
+    trie = {}
+    for name in names:
+        node = trie
+        for ch in name:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def walk(node):
+        alts = [(r"\s+" if ch == " " else re.escape(ch)) + walk(child)
+                for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        if len(alts) == 1 and "" not in node:
+            return alts[0]
+        return "(?:" + "|".join(alts) + ")" + ("?" if "" in node else "")
+    return walk(trie)
+
+class TagExtractor:
+    """
+    Tutte le classi di tag (sigle U-boat, anni, luoghi e navi del gazetteer)
+    in un'unica regex precompilata: un solo passaggio sul testo.
+    """
+    def __init__(self, gazetteer: dict):
+        self.gazetteer = gazetteer
+        parts = [r"(?P<uboat>U-\d{1,4}\b)", r"(?P<year>19[1-5]\d\b)"]
+        first = {"U", "1"}
+        if gazetteer:
+            parts.append(r"(?P<place>" + _trie_pattern(gazetteer) + r")(?!\w)")
+            first.update(name[0] for name in gazetteer)
+        # il lookahead sui possibili primi caratteri fa scartare subito quasi
+        # tutte le posizioni, prima di provare le alternative
+        self.regex = re.compile("(?=[" + re.escape("".join(sorted(first))) + r"])(?<!\w)(?:"
+                                + "|".join(parts) + ")")
+
+    def tags(self, text: str) -> set:
+        found = set()
+        for m in self.regex.finditer(text):
+            kind = m.lastgroup
+            if kind == "uboat":
+                found.add(m.group().lower())
+            elif kind == "year":
+                found.add(m.group())
+            else:
+                found.add(self.gazetteer[" ".join(m.group().split())])
+        return found
+
+_tag_extractor = None
+
+def get_tag_extractor() -> TagExtractor:
+    """Gazetteer letto e regex compilata una sola volta per processo."""
+    global _tag_extractor
+    if _tag_extractor is None:
+        _tag_extractor = TagExtractor(load_gazetteer())
+    return _tag_extractor
 
 def build_tags_it(lines_en: List[str]) -> List[str]:
-    # tag fissi + dinamici da pattern U-boat e luoghi semplici
-    tags = {"uboat","eventi","seconda-guerra-mondiale","storia","marina"}
-    ids = set(re.findall(r"\bU-\d{1,4}\b", " ".join(lines_en)))
-    tags.update({i.lower() for i in ids})
-    # Anni presenti
-    years = set(re.findall(r"\b(19[1-5]\d|1940|1941|1942|1943|1944|1945)\b", " ".join(lines_en)))
-    tags.update(years)
+    # tag fissi + dinamici (U-boat, anni, luoghi e navi del gazetteer)
+    tags = set(BASE_TAGS)
+    tags.update(get_tag_extractor().tags("\n".join(lines_en)))
     return sorted(tags)
 
 def front_matter(title: str, dt_local: datetime, tags: List[str]) -> str:
@@ -144,34 +619,31 @@ def write_post(dt_local: datetime, slug: str, body_md: str):
     return path, filename, year
 
 def run_hugo_and_publish(year: str, filename: str):
-    # build
-    subprocess.run(["hugo", "-s", BLOG_PATH], check=True)
+    # build (condivisa con hugo2tg.py: lock e salto se i sorgenti non sono cambiati)
+    result = hugo_build.build(BLOG_PATH, caller="uboat")
+    print(f"[INFO] Build Hugo: {'saltata' if result.skipped else f'{result.duration:.1f}s'}")
     # post su Telegram con anteprima
     if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
         post_url = f"{BASE_URL}/{year}/{filename.replace('.md','')}/"
         try:
-            requests.post(
-                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                data={"chat_id": TELEGRAM_CHAT_ID, "text": post_url, "disable_web_page_preview": False},
-                timeout=10
+            TelegramClient(TELEGRAM_BOT_TOKEN, timeout=10).send_message(
+                TELEGRAM_CHAT_ID, post_url, disable_web_page_preview=False
             )
         except Exception:
             pass
     return True
 
-def main():
-    dt_local = now_rome()
-    html = fetch_today_html()
-    lines_en = extract_general_events(html, dt_local)
-    if not lines_en:
-        print("[WARN] Nessun contenuto 'General Events' trovato per oggi.")
-        return
-
+def render_post(dt_local: datetime, lines_en: List[str], translate: bool = True, block_it: str = None) -> str:
+    """
+    Costruisce il markdown completo (front matter + corpo) del post del giorno.
+    `block_it` permette di passare una traduzione già pronta (backfill).
+    """
     # blocco originale in inglese
     block_en = "\n\n".join(lines_en)
 
     # traduzione se disponibile
-    block_it = try_translate_to_it(block_en)
+    if block_it is None:
+        block_it = try_translate_to_it(block_en) if translate else block_en
 
     # titolo e front matter
     title = f"U-Boat – Eventi del giorno {dt_local.strftime('%d.%m.%y')}"
@@ -192,11 +664,219 @@ def main():
         body_md.append("## General Events\n")
         body_md.append(block_en)
 
-    md = "\n\n".join(body_md).rstrip() + "\n"
+    return "\n\n".join(body_md).rstrip() + "\n"
+
+def replay(dt_local: datetime):
+    """
+    Esegue la pipeline sulla pagina in cache, senza rete né scritture:
+    stampa i tempi di ogni fase e il markdown risultante.
+    Uso: uboat_today_to_hugo.py --replay [AAAA-MM-GG]
+    """
+    t0 = time.perf_counter()
+    html = fetch_today_html(dt_local, replay=True)
+    t1 = time.perf_counter()
+    lines_en = extract_general_events(html, dt_local)
+    t2 = time.perf_counter()
+    md = render_post(dt_local, lines_en, translate=False) if lines_en else ""
+    t3 = time.perf_counter()
+    print(md)
+    print(f"[REPLAY] lettura {1000 * (t1 - t0):.1f} ms, estrazione {1000 * (t2 - t1):.1f} ms "
+          f"({len(lines_en)} righe), rendering {1000 * (t3 - t2):.1f} ms", file=sys.stderr)
+
+def bench_extract(corpus_dir: str, repeat: int = 5):
+    """
+    Confronta estrattore in streaming e BeautifulSoup su una raccolta di
+    pagine today.html salvate (di default quelle in CACHE_DIR): tempo
+    migliore su `repeat` esecuzioni e picco di memoria (tracemalloc).
+    La data di ogni pagina si ricava dal prefisso AAAA-MM-GG del nome file.
+    Uso: uboat_today_to_hugo.py --bench-extract [cartella]
+    """
+    import tracemalloc
+    pages = sorted(f for f in os.listdir(corpus_dir) if f.endswith(".html"))
+    if not pages:
+        print(f"Nessuna pagina .html in {corpus_dir}")
+        return
+    engines = [("soup", extract_general_events_soup), ("streaming", extract_general_events)]
+    totals = {name: [0.0, 0] for name, _ in engines}
+    for name in pages:
+        with open(os.path.join(corpus_dir, name), encoding="utf-8") as f:
+            html = f.read()
+        try:
+            dt = datetime.strptime(name[:10], "%Y-%m-%d")
+        except ValueError:
+            dt = now_rome()
+        results = {}
+        row = [f"{name[:40]:<40} {len(html) // 1024:>5} KiB"]
+        for engine, func in engines:
+            best = min(_timed(func, html, dt) for _ in range(repeat))
+            tracemalloc.start()
+            results[engine] = func(html, dt)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            totals[engine][0] += best
+            totals[engine][1] = max(totals[engine][1], peak)
+            row.append(f"{engine} {1000 * best:7.1f} ms {peak // 1024:>6} KiB")
+        row.append("OK" if results["soup"] == results["streaming"] else "DIVERSO")
+        print("  ".join(row))
+    for engine, (elapsed, peak) in totals.items():
+        print(f"[TOTALE] {engine}: {1000 * elapsed:.1f} ms, picco memoria {peak // 1024} KiB")
+
+def _timed(func, *args) -> float:
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+def bench_tags(megabytes: float = 4.0, repeat: int = 3):
+    """
+    Confronta l'estrazione dei tag in un solo passaggio con l'approccio a
+    più passaggi (una regex per classe e una per nome del gazetteer) su un
+    testo sintetico di `megabytes` MB costruito con i nomi del gazetteer.
+    Uso: uboat_today_to_hugo.py --bench-tags [MB]
+    """
+    import random
+    gazetteer = load_gazetteer()
+    rnd = random.Random(42)
+    names = list(gazetteer) or ["Atlantic"]
+    words = "convoy sank torpedoed patrol escort merchant ship crew survivors depth charges".split()
+    chunks, size = [], 0
+    while size < megabytes * 1024 * 1024:
+        line = " ".join(rnd.choice(words) for _ in range(12))
+        line += f" U-{rnd.randint(1, 1300)} near {rnd.choice(names)} in {rnd.randint(1935, 1948)}."
+        chunks.append(line)
+        size += len(line) + 1
+    text = "\n".join(chunks)
+
+    def multi_pass(text):
+        found = {i.lower() for i in re.findall(r"\bU-\d{1,4}\b", text)}
+        found.update(re.findall(r"\b19[1-5]\d\b", text))
+        for name, tag in gazetteer.items():
+            if re.search(r"(?<!\w)" + re.escape(name).replace(r"\ ", r"\s+") + r"(?!\w)", text):
+                found.add(tag)
+        return found
+
+    started = time.perf_counter()
+    extractor = TagExtractor(gazetteer)
+    compile_ms = 1000 * (time.perf_counter() - started)
+    print(f"Testo {size / 1024 / 1024:.1f} MB, gazetteer {len(gazetteer)} nomi, "
+          f"compilazione {compile_ms:.1f} ms")
+    results = {}
+    for engine, func in (("multi-pass", multi_pass), ("single-pass", extractor.tags)):
+        best = min(_timed(func, text) for _ in range(repeat))
+        results[engine] = func(text)
+        print(f"{engine:<12} {1000 * best:8.1f} ms  {size / 1024 / 1024 / best:6.1f} MB/s  "
+              f"{len(results[engine])} tag")
+    print("OK" if results["multi-pass"] == results["single-pass"] else "DIVERSO")
+
+def day_url(dt_local: datetime) -> str:
+    return DAY_URL.format(day=dt_local.day, month=dt_local.month)
+
+def backfill(first: datetime, last: datetime, force: bool = False):
+    """
+    Genera i post per tutte le date da `first` a `last` (incluse):
+    scarica ed estrae le pagine in parallelo (al più BACKFILL_WORKERS
+    richieste insieme e BACKFILL_RATE al secondo), traduce tutti i blocchi
+    in un'unica serie di richieste, scrive i post e rigenera il sito una
+    volta sola alla fine. Nessun messaggio Telegram.
+    Uso: uboat_today_to_hugo.py --backfill AAAA-MM-GG AAAA-MM-GG [--force]
+    """
+    started = time.time()
+    days = []
+    while first <= last:
+        days.append(first)
+        first += timedelta(days=1)
+    limiter = TokenBucket(BACKFILL_RATE, 1)
+
+    def fetch_and_extract(dt_local):
+        try:
+            cached = os.path.exists(cache_path(day_url(dt_local), dt_local, "html"))
+            if not cached or force:
+                limiter.acquire()
+            html = fetch_today_html(dt_local, url=day_url(dt_local), replay=cached and not force)
+            # solo la sezione del giorno richiesto: se uboat.net ignora day/month
+            # la pagina è quella di oggi e non va pubblicata con un'altra data
+            lines_en = extract_general_events(html, dt_local, strict=True)
+            if not lines_en:
+                print(f"[WARN] {dt_local.strftime('%Y-%m-%d')}: manca '{general_events_title(dt_local)}', giorno saltato.")
+                return dt_local, None
+            return dt_local, lines_en
+        except Exception as e:
+            print(f"[WARN] {dt_local.strftime('%Y-%m-%d')}: {e}")
+            return dt_local, None
+
+    with ThreadPoolExecutor(max_workers=BACKFILL_WORKERS) as pool:
+        extracted = list(pool.map(fetch_and_extract, days))
+    print(f"[INFO] {len(days)} pagine scaricate/estratte in {time.time() - started:.1f}s")
+
+    todo = []
+    for dt_local, lines_en in extracted:
+        if not lines_en:
+            continue  # già segnalato da fetch_and_extract
+        digest = events_digest(lines_en)
+        if force or not already_published(dt_local, digest):
+            todo.append((dt_local, lines_en, digest))
+    if not todo:
+        print("[INFO] Nessun post da generare.")
+        return
+
+    blocks_it = translate_blocks_to_it(["\n\n".join(lines_en) for _, lines_en, _ in todo])
+    for (dt_local, lines_en, digest), block_it in zip(todo, blocks_it):
+        path, _, _ = write_post(dt_local, POST_SLUG, render_post(dt_local, lines_en, block_it=block_it))
+        mark_published(dt_local, digest, path)
+        print(path)
+
+    result = hugo_build.build(BLOG_PATH, caller="uboat-backfill")
+    print(f"[INFO] Backfill: {len(todo)} post scritti, build "
+          f"{'saltata' if result.skipped else f'{result.duration:.1f}s'}, totale {time.time() - started:.1f}s")
+
+def main():
+    args = sys.argv[1:]
+    if "--backfill" in args:
+        rest = [a for a in args[args.index("--backfill") + 1:] if not a.startswith("--")]
+        tz = now_rome().tzinfo
+        try:
+            if len(rest) != 2:
+                raise ValueError("servono due date")
+            first, last = (datetime.strptime(d, "%Y-%m-%d").replace(hour=6, tzinfo=tz) for d in rest)
+        except ValueError as e:
+            print(f"[ERROR] --backfill: {e}")
+            print("Uso: uboat_today_to_hugo.py --backfill AAAA-MM-GG AAAA-MM-GG [--force]")
+            sys.exit(2)
+        backfill(first, last, force="--force" in args)
+        return
+    if "--bench-tags" in args:
+        rest = args[args.index("--bench-tags") + 1:]
+        bench_tags(float(rest[0]) if rest and not rest[0].startswith("--") else 4.0)
+        return
+    if "--bench-extract" in args:
+        rest = args[args.index("--bench-extract") + 1:]
+        bench_extract(rest[0] if rest and not rest[0].startswith("--") else CACHE_DIR)
+        return
+    dt_local = now_rome()
+    if "--replay" in args:
+        rest = args[args.index("--replay") + 1:]
+        if rest and not rest[0].startswith("--"):
+            dt_local = datetime.strptime(rest[0], "%Y-%m-%d").replace(tzinfo=dt_local.tzinfo)
+        replay(dt_local)
+        return
+
+    html = fetch_today_html(dt_local)
+    lines_en = extract_general_events(html, dt_local)
+    if not lines_en:
+        print("[WARN] Nessun contenuto 'General Events' trovato per oggi.")
+        return
+
+    # se il blocco non è cambiato dall'ultima pubblicazione non serve tradurre né rigenerare
+    digest = events_digest(lines_en)
+    if "--force" not in args and already_published(dt_local, digest):
+        print("[INFO] Eventi invariati rispetto al post già pubblicato, niente da fare.")
+        return
+
+    md = render_post(dt_local, lines_en)
 
     path, filename, year = write_post(dt_local, POST_SLUG, md)
     print(path)
     run_hugo_and_publish(year, filename)
+    mark_published(dt_local, digest, path)
 
 if __name__ == "__main__":
     main()